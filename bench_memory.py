@@ -0,0 +1,46 @@
+"""Compare the memory used by per-user dicts (the old BotData.users layout) with UserRecord.
+
+Usage: python bench_memory.py [number_of_users]
+"""
+import sys
+import tracemalloc
+
+from hhhh import UserRecord
+
+
+def dict_user(user_id: int, referrer_id: int) -> dict:
+    # Layout used by the original in-memory BotData.users
+    return {
+        'balance': 0,
+        'referrals': 0,
+        'referral_code': f"REF{user_id}",
+        'wallet': None,
+        'referred_by': referrer_id,
+        'pending_referrals': [],
+        'completed_referrals': []
+    }
+
+
+def record_user(user_id: int, referrer_id: int) -> UserRecord:
+    return UserRecord(user_id, referrer_id)
+
+
+def measure(factory, count: int) -> int:
+    tracemalloc.start()
+    users = {user_id: factory(user_id, user_id // 2) for user_id in range(1_000_000, 1_000_000 + count)}
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    results = {name: measure(factory, count) for name, factory in (("dict", dict_user), ("UserRecord", record_user))}
+    for name, size in results.items():
+        print(f"{name:>10}: {size / 2**20:8.1f} MiB total, {size / count:6.0f} bytes/user")
+    print(f"UserRecord uses {results['UserRecord'] / results['dict']:.0%} of the dict layout")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,30 @@
+import io
 import os
+import csv
+import sys
+import gzip
+import zlib
+import json
+import math
+import time
+import queue
+import logging
+import logging.handlers
+import bisect
+import signal
+import asyncio
+import sqlite3
 import datetime
+import tempfile
+import threading
+import functools
+import itertools
+import contextlib
+from collections import OrderedDict
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes, MessageHandler, filters
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -10,42 +33,1804 @@ load_dotenv()
 # Bot configuration
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_ID = 6011460052
+PAYOUT_CHANNEL = "@STAR_REACTION_PAYOUT"
 CHANNEL = "@freeearningstetantes"
+
+# Membership cache configuration (seconds / entries)
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", "300"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "30"))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+MEMBERSHIP_CONCURRENCY = int(os.getenv("MEMBERSHIP_CONCURRENCY", "10"))  # channel lookups per check
+MEMBERSHIP_GLOBAL_CONCURRENCY = int(os.getenv("MEMBERSHIP_GLOBAL_CONCURRENCY", "200"))  # across all checks
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# User storage configuration
+DATABASE_PATH = os.getenv("DATABASE_PATH", "bot.db")
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "2"))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "bot-archive.db")  # cold storage for inactive users
+
+# Maintenance sweep: expire stale pending referrals and archive inactive zero-balance users,
+# a slice of rows at a time with a pause in between so the event loop stays responsive
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "3600"))
+SWEEP_SLICE_SIZE = int(os.getenv("SWEEP_SLICE_SIZE", "200"))
+SWEEP_SLICE_PAUSE = float(os.getenv("SWEEP_SLICE_PAUSE", "0.2"))
+PENDING_REFERRAL_DAYS = float(os.getenv("PENDING_REFERRAL_DAYS", "7"))
+INACTIVE_USER_DAYS = float(os.getenv("INACTIVE_USER_DAYS", "90"))
+
+# Outbound message rate limits (Telegram allows ~30 msg/s overall, 1 msg/s per chat)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_CHAT_INTERVAL = float(os.getenv("OUTBOUND_CHAT_INTERVAL", "1"))
+OUTBOUND_GROUP_INTERVAL = float(os.getenv("OUTBOUND_GROUP_INTERVAL", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+
+# Number of updates processed in parallel (0 = one at a time); updates from the
+# same user are still handled in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Pending withdrawals are posted to the admin and payout channel as one digest per interval
+WITHDRAWAL_DIGEST_INTERVAL = float(os.getenv("WITHDRAWAL_DIGEST_INTERVAL", "60"))
+WITHDRAWAL_DIGEST_SIZE = int(os.getenv("WITHDRAWAL_DIGEST_SIZE", "25"))  # requests per message
+
+# Referral graph fraud flags: referrals credited to one referrer within the same minute,
+# and accounts each referring exactly one next account in a row
+REFERRAL_BURST_SIZE = int(os.getenv("REFERRAL_BURST_SIZE", "5"))
+REFERRAL_CHAIN_LENGTH = int(os.getenv("REFERRAL_CHAIN_LENGTH", "4"))
+
+# Rows fetched per step when exporting users
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Recipients loaded per step of an admin broadcast
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+# Messages of a page queued at once; a cancelled broadcast stops once these are sent
+BROADCAST_WINDOW = int(os.getenv("BROADCAST_WINDOW", "25"))
+
+# Update ingestion: "polling" (default) or "webhook"
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. http://127.0.0.1:8081/bot for a local fake Bot API
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public https base URL; the webhook is not registered if unset
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # required unless WEBHOOK_LISTEN is a loopback address
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+
+# Multi-process mode: with SHARDS > 1 this process becomes an ingress that receives updates and
+# forwards each to worker SHARD_INDEX = user_id % SHARDS, listening on 127.0.0.1:SHARD_BASE_PORT + index
+SHARDS = int(os.getenv("SHARDS", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))  # set by the ingress on the worker processes it starts
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8600"))
+
+# Prometheus metrics: served on the webhook server at /metrics, or on METRICS_PORT when polling
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Logging: records go through a bounded queue to a background writer thread as JSON lines
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # per-logger overrides, e.g. "bot.membership=DEBUG,httpx=WARNING"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))  # keep 1 in N noisy events
+
+log = logging.getLogger("bot")
+membership_log = logging.getLogger("bot.membership")
+referral_log = logging.getLogger("bot.referrals")
+store_log = logging.getLogger("bot.store")
+outbound_log = logging.getLogger("bot.outbound")
+handler_log = logging.getLogger("bot.handlers")
+message_log = logging.getLogger("bot.messages")
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed via extra= (user_id, route, latency_ms, ...) are included."""
+
+    STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Keep formatting off the event loop: only merge args and capture the traceback text
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class SampleFilter(logging.Filter):
+    """Let through one record in every `every`."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(every, 1)
+        self.seen = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.seen += 1
+        return self.seen % self.every == 1 or self.every == 1
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Send all logging through a bounded queue drained by a writer thread; returns the started listener."""
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream)
+
+    root = logging.getLogger()
+    root.handlers[:] = [DroppingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL.upper())
+    for override in filter(None, LOG_LEVELS.split(",")):
+        name, _, level = override.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    message_log.addFilter(SampleFilter(LOG_SAMPLE_EVERY))
+
+    listener.start()
+    return listener
+
 class BotData:
     def __init__(self):
         self.required_channels = {"@freeearningstetantes"}
-        self.users = {}
+        self.channel_ids = {}  # @username -> numeric chat id, resolved once
+        self.invite_links = {}  # @username -> invite link, resolved once
+        self.join_markup = None  # Prebuilt /start keyboard, rebuilt when channels change
         self.referral_amount = 0.5  # STAR per referral
         self.min_withdrawal = 1  # Minimum STAR for withdrawal
         self.max_withdrawal = 10  # Maximum STAR for withdrawal
         self.withdrawal_open = True
         self.withdrawal_channels = ["@freeearningstetantes"]  # Default withdrawal channel
 
+    def settings(self) -> dict:
+        """Admin-editable settings, as shared with the other workers."""
+        return {
+            'required_channels': sorted(self.required_channels),
+            'referral_amount': self.referral_amount,
+            'min_withdrawal': self.min_withdrawal,
+            'max_withdrawal': self.max_withdrawal,
+            'withdrawal_open': self.withdrawal_open,
+            'withdrawal_channels': list(self.withdrawal_channels),
+        }
+
+    def apply(self, settings: dict) -> set:
+        """Take over settings from another worker; returns the required channels added or removed."""
+        required = set(settings['required_channels'])
+        changed = required ^ self.required_channels
+        self.required_channels = required
+        self.referral_amount = settings['referral_amount']
+        self.min_withdrawal = settings['min_withdrawal']
+        self.max_withdrawal = settings['max_withdrawal']
+        self.withdrawal_open = settings['withdrawal_open']
+        self.withdrawal_channels = list(settings['withdrawal_channels'])
+        for channel in changed:
+            self.channel_ids.pop(channel, None)
+        if changed:
+            self.join_markup = None  # rebuilt on the next /start
+        return changed
+
+class MembershipCache:
+    """LRU cache of (user_id, channel) -> is_member with separate TTLs for hits and misses."""
+
+    def __init__(self, ttl: int, negative_ttl: int, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, channel: str):
+        """Return True/False for a fresh entry, None on a miss or expired entry."""
+        key = (user_id, channel)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return is_member
+
+    def set(self, user_id: int, channel: str, is_member: bool):
+        ttl = self.ttl if is_member else self.negative_ttl
+        key = (user_id, channel)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def evict(self, user_id: int, channel: str):
+        self._entries.pop((user_id, channel), None)
+
+    def evict_channel(self, channel: str):
+        for key in [key for key in self._entries if key[1] == channel]:
+            del self._entries[key]
+
+class UserRecord:
+    """One user's state. Slots keep per-user memory to a fixed set of attribute slots."""
+
+    __slots__ = ('user_id', 'balance', 'referrals', 'wallet', 'referred_by', 'pending_count',
+                 'referral_status', 'referral_date', 'referral_created', 'username', 'blocked', 'last_seen')
+
+    def __init__(self, user_id: int, referred_by: int = None):
+        self.user_id = user_id
+        self.balance = 0
+        self.referrals = 0
+        self.wallet = None
+        self.referred_by = referred_by
+        self.pending_count = 0
+        self.referral_status = None  # 'pending' or 'completed' once referred
+        self.referral_date = None  # when the referral was recorded, then when it completed
+        self.referral_created = None  # when the referral was recorded
+        self.username = None
+        self.blocked = 0  # 1 once a send fails because the user blocked the bot
+        self.last_seen = int(time.time())  # unix time, refreshed at most hourly by UserStore.touch
+
+    @property
+    def referral_code(self) -> str:
+        return f"REF{self.user_id}"
+
+class Leaderboard:
+    """Referrers ordered by completed referrals, kept sorted as counts change.
+
+    Top-n is a slice and a rank is one bisect, so neither scans the users.
+    Updates carry the absolute count and referral counts only grow, so a
+    replica can apply them repeated or out of order and still converge.
+    """
+
+    def __init__(self):
+        self._ranked = []  # (-referrals, user_id); best first
+        self._counts = {}  # user_id -> referrals, as ranked
+
+    def update(self, user_id: int, referrals: int):
+        old = self._counts.get(user_id, 0)
+        if referrals <= old:
+            return
+        if old:
+            index = bisect.bisect_left(self._ranked, (-old, user_id))
+            if index == len(self._ranked) or self._ranked[index] != (-old, user_id):
+                raise RuntimeError(f"leaderboard out of sync for {user_id}")
+            del self._ranked[index]
+        bisect.insort(self._ranked, (-referrals, user_id))
+        self._counts[user_id] = referrals
+
+    def load(self, rows):
+        """Replace the ranking with (user_id, referrals) rows already ordered best first."""
+        self._ranked = [(-referrals, user_id) for user_id, referrals in rows]
+        self._counts = {user_id: referrals for user_id, referrals in rows}
+
+    def top(self, n: int) -> list:
+        """(user_id, referrals) of the n best referrers."""
+        return [(user_id, -referrals) for referrals, user_id in self._ranked[:max(n, 0)]]
+
+    def rank(self, referrals: int):
+        """1-based rank for a referral count (ties share a rank); None without referrals."""
+        if not referrals:
+            return None
+        return bisect.bisect_left(self._ranked, (-referrals,)) + 1
+
+    def __len__(self):
+        return len(self._ranked)
+
+class ReferralGraph:
+    """In-memory index of who referred whom, for downstream and fraud queries.
+
+    Every recorded (pending or completed) referral is an edge from the referred user to
+    the referrer. Adding, completing or removing an edge updates the downstream counts
+    and levels of the referrer's ancestors, so per-user lookups are dict reads. Accounts
+    are flagged when an edge would close a loop ('ring'), when a referrer gets
+    burst_size referrals in the same minute ('burst'), or at the top of chain_length
+    single-child referrals in a row ('chain'). Flags follow the current edges: they
+    clear once what caused them is removed or, for a chain, once it branches, so a
+    restart that replays the remaining edges ends up with the same flags.
+    """
+
+    def __init__(self, burst_size: int, chain_length: int):
+        self.burst_size = burst_size
+        self.chain_length = chain_length
+        self.parent = {}      # user_id -> referrer_id
+        self.children = {}    # referrer_id -> set of user_ids
+        self.downstream = {}  # user_id -> users anywhere below
+        self.completed = {}   # user_id -> completed referrals anywhere below
+        self.levels = {}      # user_id -> levels below
+        self.flags = {}       # user_id -> set of reasons
+        self._done = set()    # user_ids whose own referral is completed
+        self._rings = {}      # user_id -> (referrer_id, date, completed) of an edge refused for closing a loop
+        self._in_rings = {}   # user_id -> refused edges they are part of
+        self._minute = {}     # user_id -> minute their referral was created
+        self._per_minute = {}  # (referrer_id, minute) -> referrals created in it
+        self._bursts = {}     # referrer_id -> minutes with burst_size or more referrals
+
+    def _ancestors(self, user_id: int):
+        node = self.parent.get(user_id)
+        while node is not None:
+            yield node
+            node = self.parent.get(node)
+
+    def _flag(self, user_id: int, reason: str, on: bool = True):
+        if on:
+            self.flags.setdefault(user_id, set()).add(reason)
+        elif reason in self.flags.get(user_id, ()):
+            self.flags[user_id].discard(reason)
+            if not self.flags[user_id]:
+                del self.flags[user_id]
+
+    def add(self, user_id: int, referrer_id: int, date: str, completed: bool = False):
+        """Add user_id's referral edge; date is when the referral was created."""
+        if user_id in self.parent or user_id in self._rings:
+            return
+        if referrer_id == user_id or user_id in self._ancestors(referrer_id):
+            self._rings[user_id] = (referrer_id, date, completed)
+            for node in {user_id, referrer_id}:
+                self._in_rings[node] = self._in_rings.get(node, 0) + 1
+                self._flag(node, 'ring')
+            return
+        self.parent[user_id] = referrer_id
+        self.children.setdefault(referrer_id, set()).add(user_id)
+        downstream = 1 + self.downstream.get(user_id, 0)
+        completed_below = self.completed.get(user_id, 0)
+        level = self.levels.get(user_id, 0) + 1
+        for node in self._ancestors(user_id):
+            self.downstream[node] = self.downstream.get(node, 0) + downstream
+            if completed_below:
+                self.completed[node] = self.completed.get(node, 0) + completed_below
+            if self.levels.get(node, 0) < level:
+                self.levels[node] = level
+            level += 1
+        if completed:
+            self.complete(user_id)
+        self._count_minute(user_id, referrer_id, (date or '')[:16], 1)  # "YYYY-MM-DD HH:MM"
+        self._update_chains(referrer_id)
+
+    def complete(self, user_id: int):
+        if user_id in self._rings:
+            # Kept for when the loop breaks and the edge is added after all
+            referrer_id, date, _ = self._rings[user_id]
+            self._rings[user_id] = (referrer_id, date, True)
+            return
+        if user_id not in self.parent or user_id in self._done:
+            return
+        self._done.add(user_id)
+        for node in self._ancestors(user_id):
+            self.completed[node] = self.completed.get(node, 0) + 1
+
+    def remove(self, user_id: int):
+        """Drop user_id's referral edge (e.g. when it expires)."""
+        if user_id in self._rings:
+            self._unring(user_id)
+            return
+        if user_id not in self.parent:
+            return
+        downstream = 1 + self.downstream.get(user_id, 0)
+        completed_below = self.completed.get(user_id, 0) + (user_id in self._done)
+        for node in self._ancestors(user_id):
+            self.downstream[node] -= downstream
+            self.completed[node] = self.completed.get(node, 0) - completed_below
+        referrer_id = self.parent.pop(user_id)
+        self._done.discard(user_id)
+        self.children[referrer_id].discard(user_id)
+        if not self.children[referrer_id]:
+            del self.children[referrer_id]
+        node = referrer_id
+        while node is not None:
+            level = max((self.levels.get(child, 0) + 1 for child in self.children.get(node, ())), default=0)
+            if level == self.levels.get(node, 0):
+                break
+            self.levels[node] = level
+            node = self.parent.get(node)
+        self._count_minute(user_id, referrer_id, self._minute.pop(user_id), -1)
+        self._update_chains(referrer_id)
+        self._retry_rings()
+
+    def _unring(self, user_id: int) -> tuple:
+        referrer_id, date, completed = self._rings.pop(user_id)
+        for node in {user_id, referrer_id}:
+            self._in_rings[node] -= 1
+            if not self._in_rings[node]:
+                del self._in_rings[node]
+                self._flag(node, 'ring', on=False)
+        return referrer_id, date, completed
+
+    def _retry_rings(self):
+        # Removing an edge can break the loop a refused edge would have closed; add those
+        # edges now, oldest first as a replay would, so the graph matches one after a restart
+        retry = [(date or '', user_id) for user_id, (referrer_id, date, _) in self._rings.items()
+                 if referrer_id != user_id and user_id not in self._ancestors(referrer_id)]
+        for _, user_id in sorted(retry):
+            if user_id in self._rings:
+                referrer_id, date, completed = self._unring(user_id)
+                self.add(user_id, referrer_id, date, completed)
+
+    def _count_minute(self, user_id: int, referrer_id: int, minute: str, delta: int):
+        key = (referrer_id, minute)
+        count = self._per_minute.get(key, 0) + delta
+        if count:
+            self._per_minute[key] = count
+        else:
+            del self._per_minute[key]
+        if delta > 0:
+            self._minute[user_id] = minute
+        bursts = self._bursts.setdefault(referrer_id, set())
+        if count >= self.burst_size:
+            bursts.add(minute)
+        else:
+            bursts.discard(minute)
+        if not bursts:
+            del self._bursts[referrer_id]
+        self._flag(referrer_id, 'burst', on=bool(bursts))
+
+    def _is_chain_top(self, user_id: int) -> bool:
+        node = user_id
+        for _ in range(self.chain_length):
+            children = self.children.get(node, ())
+            if len(children) != 1:
+                return False
+            node = next(iter(children))
+        return True
+
+    def _update_chains(self, referrer_id: int):
+        # A chain top depends on the child counts of the chain_length nodes below it, so a
+        # change at referrer_id can only affect it and its nearest chain_length - 1 ancestors
+        node = referrer_id
+        for _ in range(self.chain_length):
+            if node is None:
+                break
+            self._flag(node, 'chain', on=self._is_chain_top(node))
+            node = self.parent.get(node)
+
+    def depth(self, user_id: int) -> int:
+        """Number of referrers above user_id."""
+        return sum(1 for _ in self._ancestors(user_id))
+
+    def info(self, user_id: int) -> dict:
+        return {
+            'referrer': self.parent.get(user_id),
+            'depth': self.depth(user_id),
+            'direct': len(self.children.get(user_id, ())),
+            'downstream': self.downstream.get(user_id, 0),
+            'completed': self.completed.get(user_id, 0),
+            'levels': self.levels.get(user_id, 0),
+            'flags': sorted(self.flags.get(user_id, ())),
+        }
+
+class UserStore:
+    """SQLite-backed user repository with a bounded read-through cache and batched writes.
+
+    Records are UserRecord objects. Mutations go through the methods below, are
+    applied to the cached record immediately and are written to disk in batches by
+    ``run_flusher`` (and once more on shutdown).
+
+    Inactive users can be moved to an attached archive database (``archive``);
+    looking one up again restores them transparently.
+
+    Totals (users, outstanding balance) and the referrer leaderboard are computed
+    once on open() and then kept up to date by the mutation methods.
+
+    In multi-process mode each worker owns the users with user_id % shard_count ==
+    shard_index: totals and sweeps cover only those, while the leaderboard is global
+    and kept in step by the other workers (see ShardRouter).
+    """
+
+    TABLE = """(
+            user_id INTEGER PRIMARY KEY,
+            balance NUMERIC NOT NULL DEFAULT 0,
+            referrals INTEGER NOT NULL DEFAULT 0,
+            wallet TEXT,
+            referred_by INTEGER,
+            pending_count INTEGER NOT NULL DEFAULT 0,
+            referral_status TEXT,
+            referral_date TEXT,
+            referral_created TEXT,
+            username TEXT,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER NOT NULL DEFAULT 0
+        )"""
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS users {TABLE};
+        CREATE INDEX IF NOT EXISTS idx_users_referrals ON users(referred_by, referral_status, referral_date);
+        CREATE INDEX IF NOT EXISTS idx_users_pending ON users(referral_date) WHERE referral_status = 'pending';
+        CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+        CREATE TABLE IF NOT EXISTS archive.users {TABLE};
+        CREATE INDEX IF NOT EXISTS archive.idx_users_referrals ON users(referred_by, referral_status, referral_date);
+    """
+    # Columns added after the first release; created on open() for older databases
+    MIGRATIONS = {
+        'pending_count': "INTEGER NOT NULL DEFAULT 0",
+        'referral_status': "TEXT",
+        'referral_date': "TEXT",
+        'username': "TEXT",
+        'blocked': "INTEGER NOT NULL DEFAULT 0",
+        # Existing users count as seen at upgrade time rather than at the epoch
+        'last_seen': f"INTEGER NOT NULL DEFAULT {int(time.time())}",
+        'referral_created': "TEXT",
+    }
+    # Migrated columns filled from an existing column; completed referrals only kept
+    # their completion time in referral_date, so that is the closest creation time
+    BACKFILLS = {'referral_created': "referral_date"}
+    COLUMNS = ('user_id', 'balance', 'referrals', 'wallet', 'referred_by', 'pending_count',
+               'referral_status', 'referral_date', 'referral_created', 'username', 'blocked', 'last_seen')
+    TOUCH_INTERVAL = 3600  # seconds between last_seen writes for an active user
+
+    def __init__(self, path: str, cache_size: int, archive_path: str, shard_index: int = 0, shard_count: int = 1):
+        self.path = path
+        self.archive_path = archive_path
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard = f"user_id % {shard_count} = {shard_index}"  # SQL condition for the users this process owns
+        self.cache_size = cache_size
+        self._conn = None
+        self._write_conn = None
+        self._write_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._dirty = {}     # user_id -> record, not yet handed to the writer
+        self._inflight = {}  # user_id -> record, currently being written
+        self.hits = 0
+        self.misses = 0
+        self.total_users = 0
+        self.total_balance = 0
+        self.total_referrals = 0
+        self.leaderboard = Leaderboard()
+
+    def open(self):
+        self._write_conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._write_conn.execute("PRAGMA synchronous=NORMAL")
+        self._write_conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        for schema in ('main', 'archive'):
+            existing = {row[1] for row in self._write_conn.execute(f"PRAGMA {schema}.table_info(users)")}
+            if existing:
+                for column, definition in self.MIGRATIONS.items():
+                    if column not in existing:
+                        self._write_conn.execute(f"ALTER TABLE {schema}.users ADD COLUMN {column} {definition}")
+                        if column in self.BACKFILLS:
+                            self._write_conn.execute(
+                                f"UPDATE {schema}.users SET {column} = {self.BACKFILLS[column]}"
+                            )
+        self._write_conn.executescript(self.SCHEMA)
+        self._write_conn.commit()
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        self._load_aggregates()
+
+    def _load_aggregates(self):
+        self.total_users = self.total_balance = self.total_referrals = 0
+        # Archived users still count: they keep their referrals and can come back
+        for table in (f"main.users WHERE {self.shard}",
+                      f"archive.users WHERE {self.shard} AND user_id NOT IN (SELECT user_id FROM main.users)"):
+            users, balance = self._conn.execute(f"SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM {table}").fetchone()
+            self.total_users += users
+            self.total_balance += balance
+        rows = self._conn.execute(
+            "SELECT user_id, referrals FROM main.users WHERE referrals > 0 UNION ALL "
+            "SELECT user_id, referrals FROM archive.users WHERE referrals > 0 "
+            "AND user_id NOT IN (SELECT user_id FROM main.users) "
+            "ORDER BY referrals DESC, user_id"
+        ).fetchall()
+        self.leaderboard.load(rows)
+        self.total_referrals += sum(referrals for user_id, referrals in rows if self.owns(user_id))
+
+    def owns(self, user_id: int) -> bool:
+        return user_id % self.shard_count == self.shard_index
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+        self._write_conn.close()
+
+    def _load(self, user_id: int):
+        row = self._conn.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM main.users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        archived = row is None
+        if archived:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM archive.users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+        record = UserRecord(user_id)
+        for column, value in zip(self.COLUMNS[1:], row[1:]):
+            setattr(record, column, value)
+        if archived:
+            # Back from the archive: write the user to the main table on the next flush
+            store_log.info("Restored archived user %s", user_id, extra={"user_id": user_id})
+            self._dirty[user_id] = record
+        return record
+
+    def _remember(self, user_id: int, record: UserRecord):
+        self._cache[user_id] = record
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            # Dirty records stay reachable through _dirty/_inflight until written
+            self._cache.popitem(last=False)
+
+    def _mark_dirty(self, user_id: int, record: UserRecord):
+        self._dirty[user_id] = record
+        self._remember(user_id, record)
+
+    def get_user(self, user_id: int):
+        record = self._dirty.get(user_id) or self._inflight.get(user_id) or self._cache.get(user_id)
+        if record is None:
+            self.misses += 1
+            record = self._load(user_id)
+            if record is None:
+                return None
+        else:
+            self.hits += 1
+        self._remember(user_id, record)
+        return record
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get_user(user_id) is not None
+
+    def create_user(self, user_id: int, referred_by: int = None) -> UserRecord:
+        record = self.get_user(user_id)
+        if record is None:
+            record = UserRecord(user_id, referred_by)
+            self._mark_dirty(user_id, record)
+            self.total_users += 1
+        return record
+
+    def adjust_balance(self, user_id: int, delta, min_balance=None):
+        """Atomically add delta to the balance and return the new balance.
+
+        With min_balance set, the change is only applied if the result stays at or
+        above it; otherwise nothing changes and None is returned. This runs without
+        awaiting, so no other handler can interleave between the check and the update.
+        """
+        record = self.create_user(user_id)
+        if min_balance is not None and record.balance + delta < min_balance:
+            return None
+        record.balance += delta
+        self.total_balance += delta
+        self._mark_dirty(user_id, record)
+        return record.balance
+
+    def touch(self, user_id: int):
+        """Record that the user interacted with the bot; written at most once per TOUCH_INTERVAL."""
+        record = self.get_user(user_id)
+        now = int(time.time())
+        if record is not None and now - record.last_seen >= self.TOUCH_INTERVAL:
+            record.last_seen = now
+            self._mark_dirty(user_id, record)
+
+    def set_wallet(self, user_id: int, wallet: str):
+        record = self.create_user(user_id)
+        record.wallet = wallet
+        self._mark_dirty(user_id, record)
+
+    def set_blocked(self, user_id: int, blocked: bool):
+        record = self.get_user(user_id)
+        if record is not None and record.blocked != int(blocked):
+            record.blocked = int(blocked)
+            self._mark_dirty(user_id, record)
+
+    def page_user_ids(self, after_id: int, limit: int) -> list:
+        """Ids of users that haven't blocked the bot, in id order, starting after after_id."""
+        return [row[0] for row in self._conn.execute(
+            "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+            (after_id, limit)
+        )]
+
+    # Referral transitions are split into the referred user's side and the referrer's
+    # side, since in multi-process mode the two may be owned by different workers.
+
+    def record_referral(self, referrer_id: int, user_id: int, username: str = None) -> bool:
+        """Mark user_id as a pending referral of referrer_id. False if already referred.
+
+        The caller then applies the referrer's side with ``add_pending``.
+        """
+        user = self.create_user(user_id)
+        if user.referral_status is not None:
+            return False
+        user.referred_by = referrer_id
+        user.referral_status = 'pending'
+        user.referral_date = user.referral_created = str(datetime.datetime.now())
+        user.username = username
+        self._mark_dirty(user_id, user)
+        return True
+
+    def add_pending(self, referrer_id: int):
+        referrer = self.create_user(referrer_id)
+        referrer.pending_count += 1
+        self._mark_dirty(referrer_id, referrer)
+
+    def complete_referral(self, user_id: int, username: str):
+        """Complete user_id's pending referral; the caller credits the referrer with ``credit_referral``.
+
+        Returns the referrer's id, or None if the user has no pending referral.
+        """
+        user = self.get_user(user_id)
+        if user is None or user.referral_status != 'pending':
+            return None
+        user.referral_status = 'completed'
+        user.referral_date = str(datetime.datetime.now())
+        user.username = username
+        self._mark_dirty(user_id, user)
+        return user.referred_by
+
+    def credit_referral(self, referrer_id: int, reward) -> int:
+        """Count a completed referral for referrer_id and pay the reward; returns the new referral count."""
+        referrer = self.create_user(referrer_id)
+        referrer.pending_count = max(referrer.pending_count - 1, 0)
+        referrer.referrals += 1
+        referrer.balance += reward
+        self.leaderboard.update(referrer_id, referrer.referrals)
+        self.total_referrals += 1
+        self.total_balance += reward
+        self._mark_dirty(referrer_id, referrer)
+        return referrer.referrals
+
+    def expire_referral(self, user_id: int):
+        """Expire user_id's pending referral; returns the referrer's id (see ``release_pending``) or None."""
+        user = self.get_user(user_id)
+        if user is None or user.referral_status != 'pending':
+            return None
+        user.referral_status = 'expired'
+        self._mark_dirty(user_id, user)
+        return user.referred_by
+
+    def release_pending(self, referrer_id: int):
+        referrer = self.get_user(referrer_id)
+        if referrer is not None:
+            referrer.pending_count = max(referrer.pending_count - 1, 0)
+            self._mark_dirty(referrer_id, referrer)
+
+    def stale_referral_ids(self, before: str, limit: int) -> list:
+        """Users whose referral has been pending since before the given referral_date."""
+        return [row[0] for row in self._conn.execute(
+            f"SELECT user_id FROM users WHERE referral_status = 'pending' AND referral_date < ? AND {self.shard} LIMIT ?",
+            (before, limit)
+        )]
+
+    def inactive_user_ids(self, before: int, limit: int) -> list:
+        """Users not seen since before (unix time) who hold nothing worth keeping hot."""
+        return [row[0] for row in self._conn.execute(
+            "SELECT user_id FROM users WHERE last_seen < ? AND balance = 0 AND pending_count = 0 "
+            f"AND referral_status IS NOT 'pending' AND {self.shard} ORDER BY last_seen LIMIT ?",
+            (before, limit)
+        )]
+
+    def _archive(self, user_ids: list):
+        columns = ', '.join(self.COLUMNS)
+        placeholders = ', '.join('?' * len(user_ids))
+        with self._write_lock, self._write_conn:
+            self._write_conn.execute(
+                f"INSERT OR REPLACE INTO archive.users ({columns}) "
+                f"SELECT {columns} FROM main.users WHERE user_id IN ({placeholders})",
+                user_ids
+            )
+            self._write_conn.execute(f"DELETE FROM main.users WHERE user_id IN ({placeholders})", user_ids)
+
+    async def archive(self, user_ids: list) -> int:
+        """Move users from the main table to the archive in one transaction.
+
+        Users with unwritten changes are skipped; they'll be reconsidered next sweep.
+        Returns the number of users archived.
+        """
+        user_ids = [user_id for user_id in user_ids if user_id not in self._dirty and user_id not in self._inflight]
+        if not user_ids:
+            return 0
+        await asyncio.to_thread(self._archive, user_ids)
+        for user_id in user_ids:
+            # A user who came back while the slice was written keeps their record and is re-inserted
+            if user_id not in self._dirty:
+                self._cache.pop(user_id, None)
+        return len(user_ids)
+
+    def completed_referrals(self, referrer_id: int, limit: int = 50, offset: int = 0) -> list:
+        """(user_id, username, date) of referrer_id's completed referrals, oldest first, archived ones included.
+
+        Reads what is on disk; await flush_async() first to include unwritten changes.
+        """
+        return self._conn.execute(
+            "SELECT user_id, username, referral_date FROM main.users "
+            "WHERE referred_by = ? AND referral_status = 'completed' "
+            "UNION ALL "
+            "SELECT user_id, username, referral_date FROM archive.users "
+            "WHERE referred_by = ? AND referral_status = 'completed' "
+            "AND user_id NOT IN (SELECT user_id FROM main.users WHERE referred_by = ?) "
+            "ORDER BY referral_date LIMIT ? OFFSET ?",
+            (referrer_id, referrer_id, referrer_id, limit, offset)
+        ).fetchall()
+
+    def referral_edges(self):
+        """(user_id, referrer_id, created, status) of every pending or completed referral, oldest first."""
+        return self._conn.execute(
+            "SELECT user_id, referred_by, referral_created, referral_status FROM main.users "
+            "WHERE referral_status IN ('pending', 'completed') UNION ALL "
+            "SELECT user_id, referred_by, referral_created, referral_status FROM archive.users "
+            "WHERE referral_status IN ('pending', 'completed') AND user_id NOT IN (SELECT user_id FROM main.users) "
+            "ORDER BY referral_created"
+        )
+
+    def apply_adjustments(self, adjustments: list, dry_run: bool = False) -> list:
+        """Add each (user_id, amount) to that user's balance, all or nothing.
+
+        Returns a list of problems (unknown users, balances that would go below zero);
+        nothing is changed unless it is empty. Runs without awaiting, so the check and
+        the update see the same balances.
+        """
+        net = {}
+        for user_id, amount in adjustments:
+            net[user_id] = net.get(user_id, 0) + amount
+        errors = []
+        for user_id, amount in net.items():
+            record = self.get_user(user_id)
+            if record is None:
+                errors.append(f"user {user_id} not found")
+            elif record.balance + amount < 0:
+                errors.append(f"user {user_id}: balance {record.balance} {amount:+} would go below zero")
+        if errors or dry_run:
+            return errors
+        for user_id, amount in net.items():
+            self.adjust_balance(user_id, amount)
+        return []
+
+    EXPORT_COLUMNS = ('user_id', 'balance', 'referrals', 'wallet', 'referred_by')
+
+    def export(self, fileobj, fmt: str, chunk_size: int) -> int:
+        """Write all users, archived ones included, to fileobj as gzipped CSV or NDJSON.
+
+        Rows are streamed chunk_size at a time. Meant for a worker thread, so it reads
+        on its own connection. Returns the number of users written.
+        """
+        columns = ', '.join(self.EXPORT_COLUMNS)
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+            cursor = conn.execute(
+                f"SELECT {columns} FROM main.users UNION ALL "
+                f"SELECT {columns} FROM archive.users WHERE user_id NOT IN (SELECT user_id FROM main.users) "
+                f"ORDER BY user_id"
+            )
+            count = 0
+            with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed, \
+                    io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+                writer = csv.writer(text)
+                if fmt == 'csv':
+                    writer.writerow(self.EXPORT_COLUMNS)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    if fmt == 'csv':
+                        writer.writerows(rows)
+                    else:
+                        text.writelines(json.dumps(dict(zip(self.EXPORT_COLUMNS, row))) + "\n" for row in rows)
+                    count += len(rows)
+            return count
+        finally:
+            conn.close()
+
+    def _take_dirty(self) -> list:
+        self._inflight.update(self._dirty)
+        rows = [
+            tuple(getattr(record, column) for column in self.COLUMNS)
+            for user_id, record in self._dirty.items()
+        ]
+        self._dirty = {}
+        return rows
+
+    def _write(self, rows: list):
+        with self._write_lock, self._write_conn:
+            self._write_conn.executemany(
+                f"INSERT OR REPLACE INTO users ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                rows
+            )
+
+    def _written(self, rows: list):
+        for row in rows:
+            self._inflight.pop(row[0], None)
+
+    def read(self, sql: str, params=()) -> list:
+        """Run a read-only query on the event loop connection."""
+        return self._conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql: str, params):
+        with self._write_lock, self._write_conn:
+            cursor = self._write_conn.execute(sql, params)
+            return cursor.lastrowid if cursor.rowcount > 0 and sql.lstrip().upper().startswith("INSERT") else cursor.rowcount
+
+    async def write(self, sql: str, params=()):
+        """Run one write statement on the writer thread.
+
+        Returns the new rowid for an INSERT that added a row, otherwise the number of rows changed.
+        """
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    def _transact(self, fn):
+        with self._write_lock, self._write_conn:
+            return fn(self._write_conn)
+
+    async def transact(self, fn):
+        """Run fn(connection) in one transaction on the writer thread and return its result."""
+        return await asyncio.to_thread(self._transact, fn)
+
+    def write_script(self, script: str):
+        with self._write_lock:
+            self._write_conn.executescript(script)
+            self._write_conn.commit()
+
+    def flush(self):
+        rows = self._take_dirty()
+        if rows:
+            self._write(rows)
+        self._written(rows)
+
+    async def flush_async(self):
+        rows = self._take_dirty()
+        if not rows:
+            return
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except Exception as e:
+            store_log.error("Error writing %d users: %s", len(rows), e)
+            # Put the records back so the next flush retries them
+            for row in rows:
+                self._dirty.setdefault(row[0], self._inflight[row[0]])
+        finally:
+            self._written(rows)
+
+    async def run_flusher(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush_async()
+
+class OutboundScheduler:
+    """Background sender enforcing global and per-chat send rates with priority lanes.
+
+    Handlers call ``send`` (fire and forget) or ``send_and_wait`` and return immediately;
+    a single dispatcher task paces messages, retries 429s and network errors with
+    backoff, and keeps per-lane queue depths for monitoring.
+    """
+
+    INTERACTIVE = 0
+    NOTIFICATION = 1
+    BULK = 2
+    LANES = ('interactive', 'notification', 'bulk')
+
+    def __init__(self, global_rate: float, chat_interval: float, group_interval: float, max_retries: int):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self.bot = None
+        self._queue = None
+        self._seq = itertools.count()
+        self._next_global = 0.0
+        self._next_chat = {}  # chat_id -> monotonic time the chat may receive again
+        self._deliveries = set()  # in-flight _deliver tasks; the loop only keeps weak references
+        self.depth = [0, 0, 0]
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot) -> asyncio.Task:
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue()
+        return asyncio.create_task(self._dispatch())
+
+    def send(self, chat_id, text: str, priority: int = NOTIFICATION, **kwargs):
+        """Queue a send_message call; returns immediately."""
+        self._put(priority, [chat_id, text, kwargs, 0, None])
+
+    async def send_and_wait(self, chat_id, text: str, priority: int = NOTIFICATION, **kwargs):
+        """Queue a send_message call and wait for the resulting Message (or exception)."""
+        future = asyncio.get_running_loop().create_future()
+        self._put(priority, [chat_id, text, kwargs, 0, future])
+        return await future
+
+    def stats(self) -> dict:
+        stats = {f"queue_{lane}": depth for lane, depth in zip(self.LANES, self.depth)}
+        stats.update(sent=self.sent, failed=self.failed, retried=self.retried)
+        return stats
+
+    def _put(self, priority: int, job: list, count: bool = True):
+        if count:
+            self.depth[priority] += 1
+        self._queue.put_nowait((priority, next(self._seq), job))
+
+    def _requeue_at(self, when: float, priority: int, job: list):
+        loop = asyncio.get_running_loop()
+        loop.call_at(loop.time() + max(when - time.monotonic(), 0), self._put, priority, job, False)
+
+    def _chat_interval(self, chat_id) -> float:
+        # Private chats have positive ids; groups, channels and @usernames are stricter
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.chat_interval
+        return self.group_interval
+
+    async def _dispatch(self):
+        while True:
+            priority, _, job = await self._queue.get()
+            if job[4] is not None and job[4].done():
+                # The caller stopped waiting (e.g. a cancelled broadcast); don't send it
+                self.depth[priority] -= 1
+                continue
+            now = time.monotonic()
+            chat_ready = self._next_chat.get(job[0], 0.0)
+            if chat_ready > now:
+                # Don't hold up other chats; try this one again once it is allowed
+                self._requeue_at(chat_ready, priority, job)
+                continue
+            if self._next_global > now:
+                await asyncio.sleep(self._next_global - now)
+                now = time.monotonic()
+            self._next_global = max(self._next_global, now) + self.global_interval
+            self._next_chat[job[0]] = now + self._chat_interval(job[0])
+            if len(self._next_chat) > 10000:
+                self._next_chat = {chat: ready for chat, ready in self._next_chat.items() if ready > now}
+            task = asyncio.create_task(self._deliver(priority, job))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, priority: int, job: list):
+        chat_id, text, kwargs, attempt, future = job
+        try:
+            message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except RetryAfter as e:
+            # Flood limit: pause everything for the requested time, then retry
+            self._next_global = max(self._next_global, time.monotonic() + e.retry_after)
+            self._retry(priority, job, e, delay=e.retry_after)
+        except (Forbidden, BadRequest) as e:
+            self._finish(priority, job, error=e)
+        except NetworkError as e:
+            self._retry(priority, job, e, delay=2 ** attempt)
+        except Exception as e:
+            self._finish(priority, job, error=e)
+        else:
+            self._finish(priority, job, result=message)
+
+    def _retry(self, priority: int, job: list, error: Exception, delay: float):
+        if job[3] >= self.max_retries:
+            self._finish(priority, job, error=error)
+            return
+        job[3] += 1
+        self.retried += 1
+        self._requeue_at(time.monotonic() + delay, priority, job)
+
+    def _finish(self, priority: int, job: list, result=None, error: Exception = None):
+        self.depth[priority] -= 1
+        future = job[4]
+        if error is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+            outbound_log.warning("Failed to send message to %s: %s", job[0], error, extra={"user_id": job[0]})
+        if future is not None and not future.done():
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+class WithdrawalLedger:
+    """Append-only record of withdrawal requests.
+
+    Each request is inserted once under an idempotency key and then only moves
+    forward: pending -> sent (included in a payout digest) -> paid or rejected.
+    A request the payout channel refuses even on its own is held for the admin
+    instead, so it cannot block the digests behind it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            amount NUMERIC NOT NULL,
+            post_link TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            admin_notified INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_state ON withdrawals(state, id);
+    """
+    COLUMNS = ('id', 'user_id', 'username', 'amount', 'post_link', 'state', 'admin_notified', 'created_at')
+    TRANSITIONS = {'sent': ('pending',), 'held': ('pending',),
+                   'paid': ('pending', 'sent', 'held'), 'rejected': ('pending', 'sent', 'held')}
+    MIGRATIONS = {'admin_notified': "INTEGER NOT NULL DEFAULT 0"}
+
+    OPEN_STATES = ('pending', 'sent', 'held')  # requested but not yet paid or rejected
+    MESSAGE_LIMIT = 4096  # Telegram's limit on message text
+    LINK_LIMIT = 200  # post links are user input; longer ones are cut in digests
+
+    def __init__(self, store: UserStore):
+        self.store = store
+        self.open_count = 0
+        self.open_amount = 0
+
+    def open(self, count_existing: bool = True):
+        """Create the table; count_existing=False starts the open totals at zero.
+
+        In multi-process mode only the admin's worker (which runs all transitions) counts
+        existing requests; the others count the requests they record, so the sum is exact.
+        """
+        self.store.write_script(self.SCHEMA)
+        existing = {row[1] for row in self.store.read("PRAGMA table_info(withdrawals)")}
+        for column, definition in self.MIGRATIONS.items():
+            if column not in existing:
+                self.store.write_script(f"ALTER TABLE withdrawals ADD COLUMN {column} {definition}")
+        if count_existing:
+            self.open_count, self.open_amount = self.store.read(
+                f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals "
+                f"WHERE state IN ({', '.join('?' * len(self.OPEN_STATES))})", self.OPEN_STATES
+            )[0]
+
+    def get(self, withdrawal_id: int):
+        rows = self.store.read(f"SELECT {', '.join(self.COLUMNS)} FROM withdrawals WHERE id = ?", (withdrawal_id,))
+        return dict(zip(self.COLUMNS, rows[0])) if rows else None
+
+    def exists(self, idempotency_key: str) -> bool:
+        return bool(self.store.read("SELECT 1 FROM withdrawals WHERE idempotency_key = ?", (idempotency_key,)))
+
+    async def record(self, idempotency_key: str, user_id: int, username: str, amount, post_link: str):
+        """Insert a pending request; returns its id, or None if the key was already used."""
+        now = str(datetime.datetime.now())
+        withdrawal_id = await self.store.write(
+            "INSERT OR IGNORE INTO withdrawals "
+            "(idempotency_key, user_id, username, amount, post_link, state, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+            (idempotency_key, user_id, username, amount, post_link, now, now)
+        )
+        if withdrawal_id:
+            self.open_count += 1
+            self.open_amount += amount
+        return withdrawal_id or None
+
+    def pending(self, limit: int) -> list:
+        rows = self.store.read(
+            f"SELECT {', '.join(self.COLUMNS)} FROM withdrawals WHERE state = 'pending' ORDER BY id LIMIT ?",
+            (limit,)
+        )
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def counts(self) -> dict:
+        return dict(self.store.read("SELECT state, COUNT(*) FROM withdrawals GROUP BY state"))
+
+    async def transition(self, withdrawal_ids: list, state: str) -> int:
+        """Move requests to state if allowed from their current state; returns rows changed."""
+        allowed = self.TRANSITIONS[state]
+        where = (f"id IN ({', '.join('?' * len(withdrawal_ids))}) "
+                 f"AND state IN ({', '.join('?' * len(allowed))})")
+
+        def apply(conn):
+            count, amount = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals WHERE {where}", (*withdrawal_ids, *allowed)
+            ).fetchone()
+            conn.execute(f"UPDATE withdrawals SET state = ?, updated_at = ? WHERE {where}",
+                         (state, str(datetime.datetime.now()), *withdrawal_ids, *allowed))
+            return count, amount
+
+        count, amount = await self.store.transact(apply)
+        if state not in self.OPEN_STATES:
+            self.open_count -= count
+            self.open_amount -= amount
+        return count
+
+    async def run_digests(self, bot, interval: float, batch_size: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                while await self.send_digest(bot, batch_size):
+                    pass
+            except Exception as e:
+                log.error("Error sending withdrawal digest: %s", e)
+
+    def _line(self, req: dict) -> str:
+        link = req['post_link'] or ''
+        if len(link) > self.LINK_LIMIT:
+            link = link[:self.LINK_LIMIT - 1] + "…"
+        return f"#{req['id']} | {req['user_id']} (@{req['username'] or 'no username'}) | {req['amount']}⭐ | {link}"
+
+    def _digest(self, bot, requests: list) -> str:
+        return (f"⭐ New Withdrawal Requests (PENDING): {len(requests)}\n"
+                f"🤖 Bot: @{bot.username}\n\n" + "\n".join(self._line(req) for req in requests))
+
+    async def _notify_admin(self, bot, requests: list):
+        """Send the admin the requests they have not seen yet, once, whatever the channel does."""
+        requests = [req for req in requests if not req['admin_notified']]
+        if not requests:
+            return
+        try:
+            await outbound.send_and_wait(ADMIN_ID, self._digest(bot, requests))
+        except Exception as e:
+            log.warning("Could not send withdrawal digest to admin: %s", e)
+            return
+        ids = [req['id'] for req in requests]
+        await self.store.write(
+            f"UPDATE withdrawals SET admin_notified = 1 WHERE id IN ({', '.join('?' * len(ids))})", ids
+        )
+
+    async def _hold(self, request: dict, error: Exception):
+        log.error("Payout channel refused withdrawal #%s, holding it: %s", request['id'], error)
+        if await self.transition([request['id']], 'held'):
+            outbound.send(ADMIN_ID, f"⚠️ Withdrawal #{request['id']} could not be posted to the payout channel "
+                                    f"({error}). It is held: use /admin paid or /admin reject.")
+
+    async def send_digest(self, bot, batch_size: int) -> int:
+        """Post one digest of pending requests to the admin and payout channel; returns the requests handled.
+
+        A digest carries at most batch_size requests and stays under the message limit. If
+        the channel rejects it as a bad request, its requests are posted one by one and any
+        that still fail are held. Other errors leave them pending for the next digest.
+        """
+        requests = self.pending(batch_size)
+        for count in range(len(requests), 0, -1):
+            if len(self._digest(bot, requests[:count])) <= self.MESSAGE_LIMIT:
+                requests = requests[:count]
+                break
+        if not requests:
+            return 0
+        await self._notify_admin(bot, requests)
+        try:
+            await outbound.send_and_wait(PAYOUT_CHANNEL, self._digest(bot, requests))
+        except BadRequest:
+            for request in requests:
+                try:
+                    await outbound.send_and_wait(PAYOUT_CHANNEL, self._digest(bot, [request]))
+                except BadRequest as e:
+                    await self._hold(request, e)
+                else:
+                    await self.transition([request['id']], 'sent')
+            return len(requests)
+        await self.transition([req['id'] for req in requests], 'sent')
+        return len(requests)
+
+class Broadcaster:
+    """Resumable admin broadcasts.
+
+    Recipients are read from the user store one page at a time, sent through the
+    outbound scheduler's bulk lane, and the last finished user id is checkpointed
+    after every page so a restart resumes where the broadcast stopped.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at TEXT NOT NULL
+        );
+    """
+    COLUMNS = ('id', 'text', 'reply_markup', 'status', 'last_user_id', 'total', 'sent', 'failed',
+               'blocked', 'progress_chat_id', 'progress_message_id')
+
+    def __init__(self, store: UserStore, page_size: int, window: int):
+        self.store = store
+        self.page_size = page_size
+        self.window = window
+        self.tasks = {}  # broadcast id -> running task
+
+    def open(self):
+        self.store.write_script(self.SCHEMA)
+
+    def get(self, broadcast_id: int):
+        rows = self.store.read(f"SELECT {', '.join(self.COLUMNS)} FROM broadcasts WHERE id = ?", (broadcast_id,))
+        return dict(zip(self.COLUMNS, rows[0])) if rows else None
+
+    async def start(self, bot, text: str, reply_markup, progress_message) -> int:
+        await self.store.flush_async()
+        total = self.store.read("SELECT COUNT(*) FROM users WHERE blocked = 0")[0][0]
+        broadcast_id = await self.store.write(
+            "INSERT INTO broadcasts (text, reply_markup, total, progress_chat_id, progress_message_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (text, json.dumps(reply_markup.to_dict()) if reply_markup else None, total,
+             progress_message.chat_id, progress_message.message_id, str(datetime.datetime.now()))
+        )
+        self._spawn(bot, broadcast_id)
+        return broadcast_id
+
+    def resume_all(self, bot):
+        for (broadcast_id,) in self.store.read("SELECT id FROM broadcasts WHERE status = 'running'"):
+            log.info("Resuming broadcast #%s", broadcast_id)
+            self._spawn(bot, broadcast_id)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        changed = await self.store.write(
+            "UPDATE broadcasts SET status = 'cancelled' WHERE id = ? AND status = 'running'", (broadcast_id,)
+        )
+        task = self.tasks.pop(broadcast_id, None)
+        if task is not None:
+            task.cancel()
+        return bool(changed)
+
+    def _spawn(self, bot, broadcast_id: int):
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self.tasks[broadcast_id] = task
+        background_tasks.append(task)
+        task.add_done_callback(lambda _: self.tasks.pop(broadcast_id, None))
+
+    async def _send(self, user_id: int, text: str, reply_markup: dict) -> str:
+        # Sent from the recipient's worker: each worker paces its share of the global rate,
+        # so a broadcast uses all of it rather than the admin worker's share alone
+        try:
+            return await shards.call(user_id, "broadcast_send", text=text, reply_markup=reply_markup)
+        except Exception:
+            return 'failed'
+
+    async def deliver(self, user_id: int, text: str, reply_markup: dict) -> str:
+        """Send one broadcast message to a user this worker owns; returns sent, blocked or failed."""
+        markup = InlineKeyboardMarkup.de_json(reply_markup, outbound.bot) if reply_markup else None
+        try:
+            await outbound.send_and_wait(user_id, text, priority=OutboundScheduler.BULK, reply_markup=markup)
+            return 'sent'
+        except Forbidden:
+            self.store.set_blocked(user_id, True)
+            return 'blocked'
+        except Exception:
+            return 'failed'
+
+    async def _run(self, bot, broadcast_id: int):
+        state = self.get(broadcast_id)
+        reply_markup = json.loads(state['reply_markup']) if state['reply_markup'] else None
+        started = time.monotonic()
+        done_this_run = 0
+        while True:
+            user_ids = self.store.page_user_ids(state['last_user_id'], self.page_size)
+            if not user_ids:
+                break
+            results = []
+            for start in range(0, len(user_ids), self.window):
+                results += await asyncio.gather(*(self._send(user_id, state['text'], reply_markup)
+                                                  for user_id in user_ids[start:start + self.window]))
+            for result in ('sent', 'failed', 'blocked'):
+                state[result] += results.count(result)
+            state['last_user_id'] = user_ids[-1]
+            done_this_run += len(user_ids)
+            await self._checkpoint(state)
+            await self._report(bot, state, done_this_run / (time.monotonic() - started))
+        state['status'] = 'done'
+        await self._checkpoint(state)
+        await self._report(bot, state, None)
+
+    async def _checkpoint(self, state: dict):
+        await self.store.write(
+            "UPDATE broadcasts SET status = ?, last_user_id = ?, sent = ?, failed = ?, blocked = ? "
+            "WHERE id = ? AND status = 'running'",
+            (state['status'], state['last_user_id'], state['sent'], state['failed'], state['blocked'], state['id'])
+        )
+
+    async def _report(self, bot, state: dict, rate):
+        done = state['sent'] + state['failed'] + state['blocked']
+        total = max(state['total'], done)
+        text = (f"📣 Broadcast #{state['id']} ({state['status']})\n\n"
+                f"✅ Sent: {state['sent']}\n"
+                f"🚫 Blocked: {state['blocked']}\n"
+                f"⚠️ Failed: {state['failed']}\n"
+                f"📊 Progress: {done}/{total} ({done * 100 // max(total, 1)}%)")
+        if rate:
+            text += f"\n⏱ ETA: {datetime.timedelta(seconds=int((total - done) / rate))}"
+        try:
+            await bot.edit_message_text(text, chat_id=state['progress_chat_id'], message_id=state['progress_message_id'])
+        except Exception as e:
+            log.warning("Error updating broadcast progress: %s", e)
+
+class MaintenanceSweeper:
+    """Periodic cleanup that keeps the user table from growing without bound.
+
+    Each run expires referrals left pending longer than ``pending_age`` seconds and
+    moves users unseen for ``inactive_age`` seconds with nothing outstanding to the
+    archive. Work is done ``slice_size`` rows at a time with a pause between slices.
+    """
+
+    def __init__(self, store: UserStore, pending_age: float, inactive_age: float, slice_size: int, pause: float):
+        self.store = store
+        self.pending_age = pending_age
+        self.inactive_age = inactive_age
+        self.slice_size = slice_size
+        self.pause = pause
+        self.expired = 0
+        self.archived = 0
+        self.last_run = None
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                store_log.error("Maintenance sweep failed: %s", e)
+
+    async def sweep(self):
+        started = time.monotonic()
+        expired = await self._expire_referrals()
+        archived = await self._archive_users()
+        self.expired += expired
+        self.archived += archived
+        self.last_run = datetime.datetime.now()
+        store_log.info("Maintenance sweep: %d referrals expired, %d users archived in %.1fs",
+                       expired, archived, time.monotonic() - started)
+
+    async def _expire_referrals(self) -> int:
+        cutoff = str(datetime.datetime.now() - datetime.timedelta(seconds=self.pending_age))
+        total = 0
+        while True:
+            # Flush first so the query sees referrals completed or expired in memory
+            await self.store.flush_async()
+            user_ids = self.store.stale_referral_ids(cutoff, self.slice_size)
+            expired = 0
+            for user_id in user_ids:
+                referrer_id = self.store.expire_referral(user_id)
+                if referrer_id is not None:
+                    await shards.call(referrer_id, "release_pending")
+                    await shards.gather("graph_remove", user_id=user_id)
+                    expired += 1
+            total += expired
+            if len(user_ids) < self.slice_size or not expired:
+                return total
+            await asyncio.sleep(self.pause)
+
+    async def _archive_users(self) -> int:
+        cutoff = int(time.time() - self.inactive_age)
+        total = 0
+        while True:
+            await self.store.flush_async()
+            user_ids = self.store.inactive_user_ids(cutoff, self.slice_size)
+            archived = await self.store.archive(user_ids)
+            total += archived
+            if len(user_ids) < self.slice_size or not archived:
+                return total
+            await asyncio.sleep(self.pause)
+
+class Histogram:
+    """Cumulative latency histogram with fixed buckets (seconds), Prometheus style."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """In-process counters, gauges and latency histograms rendered as Prometheus text."""
+
+    def __init__(self):
+        self.histograms = {}  # (name, (label, value)) -> Histogram
+        self.counters = {}    # (name, (label, value)) -> float
+        self.in_flight = 0
+
+    def observe(self, name: str, label: tuple, value: float):
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[(name, label)] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, label: tuple, value: float = 1):
+        self.counters[(name, label)] = self.counters.get((name, label), 0) + value
+
+    def gauges(self) -> list:
+        """(name, label, value) for values read from other components at scrape time."""
+        gauges = [('bot_updates_in_flight', None, self.in_flight)]
+        for cache_name, cache in (('membership', membership_cache), ('users', user_store)):
+            gauges.append(('bot_cache_hits_total', ('cache', cache_name), cache.hits))
+            gauges.append(('bot_cache_misses_total', ('cache', cache_name), cache.misses))
+        for lane, depth in zip(OutboundScheduler.LANES, outbound.depth):
+            gauges.append(('bot_outbound_queue_depth', ('lane', lane), depth))
+        for result in ('sent', 'failed', 'retried'):
+            gauges.append(('bot_outbound_messages_total', ('result', result), getattr(outbound, result)))
+        gauges.append(('bot_users_total', None, user_store.total_users))
+        gauges.append(('bot_balance_outstanding', None, user_store.total_balance))
+        gauges.append(('bot_withdrawals_open', None, withdrawal_ledger.open_count))
+        gauges.append(('bot_referrals_expired_total', None, sweeper.expired))
+        gauges.append(('bot_users_archived_total', None, sweeper.archived))
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, DroppingQueueHandler):
+                gauges.append(('bot_log_records_dropped_total', None, handler.dropped))
+        return gauges
+
+    @staticmethod
+    def _labels(label: tuple, extra: str = "") -> str:
+        parts = [f'{label[0]}="{label[1]}"'] if label else []
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for (name, label), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                bucket_label = self._labels(label, 'le="%s"' % bound)
+                lines.append(f"{name}_bucket{bucket_label} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(label)} {histogram.total}")
+            lines.append(f"{name}_count{self._labels(label)} {histogram.count}")
+        for (name, label), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._labels(label)} {value}")
+        for name, label, value in self.gauges():
+            lines.append(f"{name}{self._labels(label)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        def rows(name: str, error_name: str) -> list:
+            result = []
+            for (metric, label), histogram in sorted(self.histograms.items(), key=lambda item: -item[1].total):
+                if metric != name:
+                    continue
+                errors = self.counters.get((error_name, label), 0)
+                result.append(f"{label[1]}: {histogram.count}x, avg {histogram.total / histogram.count * 1000:.0f} ms, "
+                              f"p99 ≤ {histogram.quantile(0.99) * 1000:.0f} ms, {errors:.0f} errors")
+            return result
+
+        def hit_rate(cache) -> str:
+            total = cache.hits + cache.misses
+            return f"{cache.hits / total:.0%} of {total}" if total else "n/a"
+
+        return "\n".join(
+            ["📊 Handlers (by total time)"] + rows('bot_handler_duration_seconds', 'bot_handler_errors_total') +
+            ["", "🌐 Bot API methods (by total time)"] + rows('bot_api_request_duration_seconds', 'bot_api_errors_total') +
+            ["", f"🗂 Membership cache hit rate: {hit_rate(membership_cache)}",
+             f"🗂 User cache hit rate: {hit_rate(user_store)}",
+             f"⏳ Updates in flight: {self.in_flight}"]
+        )
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and errors per Bot API method."""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = ('api_method', url.rsplit('/', 1)[-1])
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_api_errors_total', api_method)
+            raise
+        finally:
+            metrics.observe('bot_api_request_duration_seconds', api_method, time.perf_counter() - started)
+        if code >= 400:
+            metrics.inc('bot_api_errors_total', api_method)
+        return code, payload
+
+class KeyedLocks:
+    """One asyncio.Lock per key, created on demand and dropped when nobody holds or waits for it."""
+
+    def __init__(self):
+        self._locks = {}  # key -> [lock, holders + waiters]
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+class ShardRouter:
+    """Runs per-user operations on the worker process that owns the user.
+
+    Each user belongs to worker ``user_id % count`` and only that worker changes their
+    record. Code touching another user goes through ``call`` (one registered operation
+    on one user), ``broadcast`` (every other worker, e.g. settings changes) or ``gather``
+    (every worker including this one). Remote operations are posted as JSON to the
+    worker's /shard endpoint on 127.0.0.1; with a single shard everything runs in-process.
+    """
+
+    def __init__(self, index: int, count: int, base_port: int):
+        self.index = index
+        self.count = count
+        self.base_port = base_port
+        self.ops = {}  # name -> function(**args), sync or async
+        self._session = None
+
+    def op(self, callback):
+        """Register a function other workers may call by name."""
+        self.ops[callback.__name__] = callback
+        return callback
+
+    def shard_of(self, user_id: int) -> int:
+        return user_id % self.count
+
+    def port(self, index: int) -> int:
+        return self.base_port + index
+
+    async def call(self, user_id: int, op: str, **args):
+        """Run op(user_id=user_id, **args) on the user's worker and return its result."""
+        return await self._on(self.shard_of(user_id), op, {'user_id': user_id, **args})
+
+    async def broadcast(self, op: str, **args) -> list:
+        return await asyncio.gather(*(self._on(index, op, args) for index in range(self.count) if index != self.index))
+
+    async def call_shard(self, index: int, op: str, **args):
+        return await self._on(index, op, args)
+
+    async def gather(self, op: str, **args) -> list:
+        return await asyncio.gather(*(self._on(index, op, args) for index in range(self.count)))
+
+    async def _on(self, index: int, op: str, args: dict):
+        if index == self.index:
+            return await self.run(op, args)
+        from aiohttp import ClientSession, TCPConnector
+        if self._session is None:
+            # No connection limit: operations may call further workers while holding a connection
+            self._session = ClientSession(connector=TCPConnector(limit=0))
+        async with self._session.post(f"http://127.0.0.1:{self.port(index)}/shard", json={'op': op, 'args': args}) as response:
+            payload = await response.json()
+        if 'error' in payload:
+            raise RuntimeError(f"{op} on shard {index} failed: {payload['error']}")
+        return payload['result']
+
+    async def run(self, op: str, args: dict):
+        result = self.ops[op](**args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def handle(self, request):
+        """aiohttp handler for /shard requests from other workers."""
+        from aiohttp import web
+        payload = await request.json()
+        try:
+            result = await self.run(payload['op'], payload['args'])
+        except Exception as e:
+            log.error("Shard operation %s failed: %s", payload.get('op'), e)
+            return web.json_response({'error': str(e)})
+        return web.json_response({'result': result})
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
 # Initialize bot data
 bot_data = BotData()
+shards = ShardRouter(max(SHARD_INDEX, 0), SHARDS if SHARD_INDEX >= 0 else 1, SHARD_BASE_PORT)
+user_store = UserStore(DATABASE_PATH, USER_CACHE_SIZE, ARCHIVE_PATH, shards.index, shards.count)
+withdrawal_ledger = WithdrawalLedger(user_store)
+broadcaster = Broadcaster(user_store, BROADCAST_PAGE_SIZE, BROADCAST_WINDOW)
+sweeper = MaintenanceSweeper(user_store, PENDING_REFERRAL_DAYS * 86400, INACTIVE_USER_DAYS * 86400,
+                             SWEEP_SLICE_SIZE, SWEEP_SLICE_PAUSE)
+referral_graph = ReferralGraph(REFERRAL_BURST_SIZE, REFERRAL_CHAIN_LENGTH)
+user_locks = KeyedLocks()
+metrics = Metrics()
+outbound = OutboundScheduler(OUTBOUND_GLOBAL_RATE / shards.count, OUTBOUND_CHAT_INTERVAL, OUTBOUND_GROUP_INTERVAL, OUTBOUND_MAX_RETRIES)
+background_tasks = []
+membership_cache = MembershipCache(MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_CACHE_SIZE)
+membership_semaphore = asyncio.Semaphore(MEMBERSHIP_GLOBAL_CONCURRENCY)
+
+def callback_route(update: Update) -> str:
+    """Metrics label for a callback query: its route key, e.g. withdraw_5 -> button:withdraw_."""
+    return f"button:{resolve_callback(update.callback_query.data or '')[0]}"
+
+def instrument(name):
+    """Record latency, errors and in-flight count for a handler.
+
+    name is a fixed handler name or a function deriving one from the update.
+    """
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+            label = ('handler', name(update) if callable(name) else name)
+            metrics.in_flight += 1
+            started = time.perf_counter()
+            try:
+                return await callback(update, context, *args)
+            except Exception:
+                metrics.inc('bot_handler_errors_total', label)
+                raise
+            finally:
+                latency = time.perf_counter() - started
+                metrics.in_flight -= 1
+                metrics.observe('bot_handler_duration_seconds', label, latency)
+                if handler_log.isEnabledFor(logging.DEBUG):
+                    handler_log.debug("Handled update", extra={
+                        "user_id": update.effective_user.id if update.effective_user else None,
+                        "route": label[1],
+                        "latency_ms": round(latency * 1000, 1),
+                    })
+        return wrapper
+    return decorator
+
+def serialize_per_user(callback):
+    """Run the handler under the user's lock so one user's updates are processed in order."""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None:
+            return await callback(update, context)
+        async with user_locks(update.effective_user.id):
+            return await callback(update, context)
+    return wrapper
+
+async def resolve_invite_link(channel: str, bot) -> str:
+    channel_name = channel[1:] # Remove @ symbol
+    try:
+        chat = await bot.get_chat(channel)
+        bot_data.channel_ids[channel] = chat.id
+        invite_link = chat.invite_link
+        if not invite_link:
+            invite_link = await bot.create_chat_invite_link(chat.id)
+            invite_link = invite_link.invite_link
+    except Exception as e:
+        membership_log.warning("Error getting invite link for %s: %s", channel, e)
+        invite_link = f"https://t.me/{channel_name}"
+    bot_data.invite_links[channel] = invite_link
+    return invite_link
+
+async def refresh_channel_cache(bot):
+    """Resolve invite links for new required channels and rebuild the /start keyboard."""
+    for channel in list(bot_data.invite_links):
+        if channel not in bot_data.required_channels:
+            del bot_data.invite_links[channel]
+    missing = [channel for channel in bot_data.required_channels if channel not in bot_data.invite_links]
+    await asyncio.gather(*(resolve_invite_link(channel, bot) for channel in missing))
+
+    keyboard = [
+        [InlineKeyboardButton(f"Join {channel}", url=bot_data.invite_links[channel])]
+        for channel in bot_data.required_channels
+    ]
+    keyboard.append([InlineKeyboardButton("✅ Check Membership", callback_data="check_membership")])
+    bot_data.join_markup = InlineKeyboardMarkup(keyboard)
+
+async def get_join_markup(bot) -> InlineKeyboardMarkup:
+    if bot_data.join_markup is None:
+        await refresh_channel_cache(bot)
+    return bot_data.join_markup
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # Show welcome message with verification buttons
-    keyboard = []
-    for channel in bot_data.required_channels:
-        channel_name = channel[1:] # Remove @ symbol
-        try:
-            chat = await context.bot.get_chat(channel)
-            invite_link = chat.invite_link
-            if not invite_link:
-                invite_link = await context.bot.create_chat_invite_link(chat.id)
-                invite_link = invite_link.invite_link
-        except Exception as e:
-            print(f"Error getting invite link for {channel}: {e}")
-            invite_link = f"https://t.me/{channel_name}"
-        
-        keyboard.append([InlineKeyboardButton(f"Join {channel}", url=invite_link)])
-    
-    keyboard.append([InlineKeyboardButton("✅ Check Membership", callback_data="check_membership")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = await get_join_markup(context.bot)
 
     await update.message.reply_text(
         "🌟 Welcome to STAR Reaction Bot! ⭐\n\n"
@@ -65,71 +1850,52 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             referrer_id = int(context.args[0][3:])  # Extract ID from REF code
             
             # Make sure referrer exists and is not self-referring
-            if referrer_id in bot_data.users and referrer_id != user_id:
+            if referrer_id != user_id and await shards.call(referrer_id, "user_exists"):
                 referrer = await context.bot.get_chat(referrer_id)
-                
-                # Initialize referrer's referral data if needed
-                if 'pending_referrals' not in bot_data.users[referrer_id]:
-                    bot_data.users[referrer_id]['pending_referrals'] = []
-                if 'completed_referrals' not in bot_data.users[referrer_id]:
-                    bot_data.users[referrer_id]['completed_referrals'] = []
-                
-                # Check if user hasn't been referred before
-                if (user_id not in bot_data.users[referrer_id]['pending_referrals'] and 
-                    user_id not in [ref['user_id'] for ref in bot_data.users[referrer_id].get('completed_referrals', [])]):
-                    
-                    # Initialize new user data
-                    bot_data.users[user_id] = {
-                        'balance': 0,
-                        'referrals': 0,
-                        'referral_code': f"REF{user_id}",
-                        'wallet': None,
-                        'referred_by': referrer_id
-                    }
-                    
-                    # Add to pending referrals
-                    bot_data.users[referrer_id]['pending_referrals'].append(user_id)
-                    
+
+                # Add to pending referrals unless the user has been referred before
+                if user_store.record_referral(referrer_id, user_id, update.effective_user.username):
+                    await shards.call(referrer_id, "add_pending")
+                    await shards.gather("graph_add", user_id=user_id, referrer_id=referrer_id,
+                                        date=user_store.get_user(user_id).referral_created)
+
                     # Send notification messages
-                    await update.message.reply_text(
+                    outbound.send(
+                        update.effective_chat.id,
                         f"✨ Welcome! You were referred by @{referrer.username}!\n"
-                        "Join all channels and verify membership to activate the referral reward!"
+                        "Join all channels and verify membership to activate the referral reward!",
+                        priority=OutboundScheduler.INTERACTIVE
                     )
                     
                     # Notify referrer about new referral
-                    await context.bot.send_message(
-                        chat_id=referrer_id,
-                        text=f"🎉 New referral! @{update.effective_user.username} joined using your link!\n"
-                             "They need to verify channel membership to activate your reward."
+                    outbound.send(
+                        referrer_id,
+                        f"🎉 New referral! @{update.effective_user.username} joined using your link!\n"
+                        "They need to verify channel membership to activate your reward."
                     )
                     
-                    print(f"Added pending referral: {user_id} for referrer: {referrer_id}")
+                    referral_log.info("Added pending referral: %s for referrer: %s", user_id, referrer_id,
+                                      extra={"user_id": user_id, "referrer_id": referrer_id})
         except Exception as e:
-            print(f"Referral error: {e}")
+            referral_log.error("Referral error: %s", e, extra={"user_id": user_id})
             await update.message.reply_text("❌ There was an error processing the referral. Please try again.")
 
 
-    # Register new user if needed
-    if user_id not in bot_data.users:
-        bot_data.users[user_id] = {
-            'balance': 0,
-            'referrals': 0,
-            'referral_code': f"REF{user_id}",
-            'wallet': None
-        }
+    # Register new user if needed; a user sending /start has unblocked the bot
+    await ensure_user_exists(user_id)
+    user_store.set_blocked(user_id, False)
 
-async def handle_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
     user_id = update.effective_user.id
-    user_data = bot_data.users[user_id]
-    bot = await context.bot.get_me()
-    referral_link = f"https://t.me/{bot.username}?start={user_data['referral_code']}"
+    user_data = user_store.create_user(user_id)
+    referral_link = f"https://t.me/{context.bot.username}?start={user_data.referral_code}"
 
     await update.callback_query.answer()
     await update.callback_query.message.reply_text(
         f"🔗 Your referral link: {referral_link}\n"
         f"⭐ Reward per referral: {bot_data.referral_amount} ⭐\n"  # Added line showing reward per referral
-        f"👥 Total referrals: {user_data['referrals']}\n"
-        f"💰 Earned from referrals: {user_data['referrals'] * bot_data.referral_amount} ⭐"
+        f"👥 Total referrals: {user_data.referrals}\n"
+        f"💰 Earned from referrals: {user_data.referrals * bot_data.referral_amount} ⭐"
     )
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, override_command=None):
@@ -148,7 +1914,21 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
             "ℹ️ Available Admin Commands:\n\n"
             "💰 Balance Management:\n"
             "/add_balance [user_id] [amount] - Add balance to user\n"
-            "/deduct_balance [user_id] [amount] - Deduct balance from user\n\n"
+            "/deduct_balance [user_id] [amount] - Deduct balance from user\n"
+            "/admin referrals [user_id] [page] - List a user's completed referrals\n"
+            "/admin queue - Show outbound message queue depth\n"
+            "/admin stats - Show handler and Bot API latency stats\n"
+            "/admin totals - Show user, balance and withdrawal totals\n"
+            "/admin top [n] - Show the top n referrers\n"
+            "/admin graph [user_id] - Show a user's referral tree and fraud flags\n"
+            "/admin suspicious - List accounts flagged by the referral graph\n"
+            "/admin withdrawals - Show withdrawal request counts\n"
+            "/admin paid [id] - Mark a withdrawal request as paid\n"
+            "/admin reject [id] - Reject a withdrawal request and refund it\n"
+            "/admin broadcast [text] - Message all users (add 'Label | https://url' lines for buttons)\n"
+            "/admin cancel_broadcast [id] - Stop a running broadcast\n"
+            "/admin export [csv|ndjson] - Download all users as a gzipped file\n"
+            "/admin import - Apply a CSV of balance adjustments (user_id,amount)\n\n"
             "频道管理:\n"
             "/add_channel [channel] - Add a required channel\n"
             "/remove_channel [channel] - Remove a required channel\n"
@@ -169,9 +1949,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
         try:
             user_id = int(context.args[0])
             amount = int(context.args[1])
-            if user_id not in bot_data.users:
-                bot_data.users[user_id] = {'balance': 0, 'referrals': 0, 'referral_code': f"REF{user_id}"}
-            bot_data.users[user_id]['balance'] += amount
+            await shards.call(user_id, "adjust_balance", delta=amount)
             await update.message.reply_text(f"Added {amount} ⭐ to user {user_id}")
         except ValueError:
             await update.message.reply_text("Invalid user_id or amount")
@@ -184,9 +1962,8 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
         try:
             user_id = int(context.args[0])
             amount = int(context.args[1])
-            if user_id in bot_data.users:
-                if bot_data.users[user_id]['balance'] >= amount:
-                    bot_data.users[user_id]['balance'] -= amount
+            if await shards.call(user_id, "user_exists"):
+                if await shards.call(user_id, "adjust_balance", delta=-amount, min_balance=0) is not None:
                     await update.message.reply_text(f"Deducted {amount} ⭐ from user {user_id}")
                 else:
                     await update.message.reply_text("User doesn't have enough balance")
@@ -196,6 +1973,166 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
             await update.message.reply_text("Invalid user_id or amount")
             return
 
+    elif command == "referrals":
+        if not context.args:
+            await update.message.reply_text("Usage: /admin referrals [user_id] [page]")
+            return
+        try:
+            user_id = int(context.args[0])
+            page = int(context.args[1]) if len(context.args) > 1 else 1
+        except ValueError:
+            await update.message.reply_text("Invalid user_id or page")
+            return
+        result = await shards.call(user_id, "referral_page", limit=50, offset=(page - 1) * 50)
+        if result is None:
+            await update.message.reply_text("User not found")
+            return
+        lines = [f"{ref_id} (@{username or 'no username'}) - {date}" for ref_id, username, date in result['rows']]
+        await update.message.reply_text(
+            f"👥 Referrals of {user_id}: {result['referrals']} completed, "
+            f"{result['pending_count']} pending\n\n" + ("\n".join(lines) or "No completed referrals on this page.")
+        )
+
+    elif command == "stats":
+        await update.message.reply_text(metrics.summary())
+
+    elif command == "totals":
+        parts = await shards.gather("totals")
+        total = {key: sum(part[key] for part in parts) for key in parts[0]}
+        await update.message.reply_text(
+            "📈 Totals\n\n"
+            f"👤 Users: {total['users']}\n"
+            f"💰 Outstanding balance: {total['balance']} ⭐\n"
+            f"👥 Completed referrals: {total['referrals']} by {len(user_store.leaderboard)} referrers\n"
+            f"💳 Open withdrawals: {total['withdrawals']} ({total['withdrawal_amount']} ⭐)"
+        )
+
+    elif command == "top":
+        try:
+            n = max(1, min(int(context.args[0]), 100)) if context.args else 10
+        except ValueError:
+            await update.message.reply_text("Usage: /admin top [n]")
+            return
+        lines = []
+        for user_id, referrals in user_store.leaderboard.top(n):
+            rank = user_store.leaderboard.rank(referrals)
+            lines.append(f"{rank}. {user_id} - {referrals} referrals")
+        await update.message.reply_text(f"🏆 Top {n} referrers\n\n" + ("\n".join(lines) or "No referrals yet."))
+
+    elif command == "graph":
+        try:
+            user_id = int(context.args[0])
+        except (IndexError, ValueError):
+            await update.message.reply_text("Usage: /admin graph [user_id]")
+            return
+        info = referral_graph.info(user_id)
+        await update.message.reply_text(
+            f"🌳 Referral tree of {user_id}\n\n"
+            f"⬆️ Referred by: {info['referrer'] or 'nobody'} (depth {info['depth']})\n"
+            f"👥 Direct referrals: {info['direct']}\n"
+            f"⬇️ Downstream users: {info['downstream']} ({info['completed']} completed) over {info['levels']} levels\n"
+            f"🚩 Flags: {', '.join(info['flags']) or 'none'}"
+        )
+
+    elif command == "suspicious":
+        flagged = sorted(referral_graph.flags.items(), key=lambda item: -referral_graph.downstream.get(item[0], 0))
+        lines = [f"{user_id}: {', '.join(sorted(reasons))} ({referral_graph.downstream.get(user_id, 0)} downstream)"
+                 for user_id, reasons in flagged[:50]]
+        await update.message.reply_text(
+            f"🚩 Flagged accounts: {len(flagged)}\n\n" + ("\n".join(lines) or "None.")
+        )
+
+    elif command == "queue":
+        stats = outbound.stats()
+        await update.message.reply_text(
+            "📤 Outbound queue\n\n" + "\n".join(f"{name}: {value}" for name, value in stats.items())
+        )
+
+    elif command == "withdrawals":
+        counts = withdrawal_ledger.counts()
+        await update.message.reply_text(
+            "💳 Withdrawal requests\n\n" +
+            "\n".join(f"{state}: {counts.get(state, 0)}" for state in ('pending', 'sent', 'held', 'paid', 'rejected'))
+        )
+
+    elif command in ("paid", "reject"):
+        if not context.args:
+            await update.message.reply_text(f"Usage: /admin {command} [withdrawal_id]")
+            return
+        try:
+            withdrawal_id = int(context.args[0].lstrip('#'))
+        except ValueError:
+            await update.message.reply_text("Invalid withdrawal_id")
+            return
+        withdrawal = withdrawal_ledger.get(withdrawal_id)
+        state = 'paid' if command == "paid" else 'rejected'
+        if withdrawal is None or not await withdrawal_ledger.transition([withdrawal_id], state):
+            await update.message.reply_text("Withdrawal request not found or already closed")
+            return
+        if state == 'rejected':
+            await shards.call(withdrawal['user_id'], "adjust_balance", delta=withdrawal['amount'])
+            outbound.send(withdrawal['user_id'], f"❌ Your withdrawal request #{withdrawal_id} was rejected and {withdrawal['amount']}⭐ refunded.")
+        else:
+            outbound.send(withdrawal['user_id'], f"✅ Your withdrawal request #{withdrawal_id} for {withdrawal['amount']}⭐ has been paid!")
+        await update.message.reply_text(f"Withdrawal #{withdrawal_id} marked as {state}")
+
+    elif command == "broadcast":
+        parts = (update.message.text or "").split(maxsplit=2)
+        if len(parts) < 3:
+            await update.message.reply_text(
+                "Usage: /admin broadcast [text]\nAdd lines like 'Label | https://url' at the end for buttons."
+            )
+            return
+        text_lines, keyboard = [], []
+        for line in parts[2].splitlines():
+            label, _, url = line.partition("|")
+            if url.strip().startswith(("http://", "https://", "tg://")):
+                keyboard.append([InlineKeyboardButton(label.strip(), url=url.strip())])
+            else:
+                text_lines.append(line)
+        text = "\n".join(text_lines).strip()
+        if not text:
+            # Telegram rejects a message with buttons but no text
+            await update.message.reply_text("The broadcast needs some text besides the button lines.")
+            return
+        progress = await update.message.reply_text("📣 Starting broadcast...")
+        broadcast_id = await broadcaster.start(
+            context.bot, text, InlineKeyboardMarkup(keyboard) if keyboard else None, progress
+        )
+        log.info("Started broadcast #%s", broadcast_id)
+
+    elif command == "cancel_broadcast":
+        try:
+            broadcast_id = int(context.args[0].lstrip('#'))
+        except (IndexError, ValueError):
+            await update.message.reply_text("Usage: /admin cancel_broadcast [id]")
+            return
+        if await broadcaster.cancel(broadcast_id):
+            await update.message.reply_text(f"Broadcast #{broadcast_id} cancelled")
+        else:
+            await update.message.reply_text("Broadcast not found or already finished")
+
+    elif command == "export":
+        fmt = context.args[0].lower() if context.args else 'csv'
+        if fmt not in ('csv', 'ndjson'):
+            await update.message.reply_text("Usage: /admin export [csv|ndjson]")
+            return
+        await shards.gather("flush_users")
+        with tempfile.TemporaryFile() as export_file:
+            count = await asyncio.to_thread(user_store.export, export_file, fmt, EXPORT_CHUNK_SIZE)
+            export_file.seek(0)
+            await update.message.reply_document(
+                export_file, filename=f"users-{datetime.date.today()}.{fmt}.gz", caption=f"📦 {count} users"
+            )
+
+    elif command == "import":
+        context.user_data['expecting_import'] = True
+        await update.message.reply_text(
+            "📥 Send the adjustments as a CSV file (optionally gzipped) with the columns user_id,amount.\n"
+            "Amounts are added to balances; use negative amounts to deduct. "
+            "Nothing is applied if any row is invalid."
+        )
+
     if command == "add_channel":
         if len(context.args) < 2:
             await update.message.reply_text("Usage: /add_channel [channel]\nExample: /add_channel @channelname")
@@ -204,6 +2141,11 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
         if not channel.startswith('@'):
             channel = '@' + channel
         bot_data.required_channels.add(channel)
+        bot_data.channel_ids.pop(channel, None)
+        bot_data.invite_links.pop(channel, None)
+        membership_cache.evict_channel(channel)
+        await refresh_channel_cache(context.bot)
+        await share_settings()
         await update.message.reply_text(f"✅ Added channel: {channel}\nCurrent channels: {', '.join(bot_data.required_channels)}")
 
     elif command == "remove_channel":
@@ -215,6 +2157,10 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
             channel = '@' + channel
         try:
             bot_data.required_channels.remove(channel)
+            bot_data.channel_ids.pop(channel, None)
+            membership_cache.evict_channel(channel)
+            await refresh_channel_cache(context.bot)
+            await share_settings()
             await update.message.reply_text(f"✅ Removed channel: {channel}\nRemaining channels: {', '.join(bot_data.required_channels)}")
         except KeyError:
             await update.message.reply_text(f"⚠️ Channel {channel} not found in required channels!\nCurrent channels: {', '.join(bot_data.required_channels)}")
@@ -222,15 +2168,18 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
     elif command == "set_min_withdrawal":
         amount = int(context.args[1])
         bot_data.min_withdrawal = amount
+        await share_settings()
         await update.message.reply_text(f"Set minimum withdrawal to {amount} DOGS")
 
     elif command == "set_referral_amount":
         amount = int(context.args[1])
         bot_data.referral_amount = amount
+        await share_settings()
         await update.message.reply_text(f"Set referral amount to {amount} DOGS")
 
     elif command == "toggle_withdrawal":
         bot_data.withdrawal_open = not bot_data.withdrawal_open
+        await share_settings()
         status = "opened" if bot_data.withdrawal_open else "closed"
         await update.message.reply_text(f"Withdrawals are now {status}")
 
@@ -241,6 +2190,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
         channel = context.args[1]
         if channel not in bot_data.withdrawal_channels:
             bot_data.withdrawal_channels.append(channel)
+            await share_settings()
             await update.message.reply_text(f"Added withdrawal channel: {channel}")
         else:
             await update.message.reply_text("Channel already exists!")
@@ -252,255 +2202,794 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, over
         channel = context.args[1]
         if channel in bot_data.withdrawal_channels:
             bot_data.withdrawal_channels.remove(channel)
+            await share_settings()
             await update.message.reply_text(f"Removed withdrawal channel: {channel}")
         else:
             await update.message.reply_text("Channel not found!")
 
 async def ensure_user_exists(user_id: int):
-    if user_id not in bot_data.users:
-        bot_data.users[user_id] = {
-            'balance': 0,
-            'referrals': 0,
-            'referral_code': f"REF{user_id}",
-            'wallet': None
-        }
+    user_store.create_user(user_id)
+    user_store.touch(user_id)
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Operations on another user's record go through shards.call so that they run on the
+# worker owning that user; the ones below are what workers may ask of each other.
+
+@shards.op
+def user_exists(user_id: int) -> bool:
+    return user_id in user_store
+
+@shards.op
+def add_pending(user_id: int):
+    user_store.add_pending(user_id)
+
+@shards.op
+def release_pending(user_id: int):
+    user_store.release_pending(user_id)
+
+@shards.op
+async def credit_referral(user_id: int, reward):
+    referrals = user_store.credit_referral(user_id, reward)
+    await shards.broadcast("leaderboard_update", user_id=user_id, referrals=referrals)
+
+@shards.op
+def leaderboard_update(user_id: int, referrals: int):
+    user_store.leaderboard.update(user_id, referrals)
+
+@shards.op
+def adjust_balance(user_id: int, delta, min_balance=None):
+    return user_store.adjust_balance(user_id, delta, min_balance)
+
+@shards.op
+def set_blocked(user_id: int, blocked: bool):
+    user_store.set_blocked(user_id, blocked)
+
+@shards.op
+async def broadcast_send(user_id: int, text: str, reply_markup: dict = None) -> str:
+    return await broadcaster.deliver(user_id, text, reply_markup)
+
+@shards.op
+async def referral_page(user_id: int, limit: int, offset: int):
+    await user_store.flush_async()
+    user_data = user_store.get_user(user_id)
+    if user_data is None:
+        return None
+    return {'referrals': user_data.referrals, 'pending_count': user_data.pending_count,
+            'rows': user_store.completed_referrals(user_id, limit, offset)}
+
+@shards.op
+def totals() -> dict:
+    return {'users': user_store.total_users, 'balance': user_store.total_balance,
+            'referrals': user_store.total_referrals,
+            'withdrawals': withdrawal_ledger.open_count, 'withdrawal_amount': withdrawal_ledger.open_amount}
+
+# Every worker keeps the whole referral graph; changes are applied everywhere with shards.gather
+
+@shards.op
+def graph_add(user_id: int, referrer_id: int, date: str):
+    referral_graph.add(user_id, referrer_id, date)
+
+@shards.op
+def graph_complete(user_id: int):
+    referral_graph.complete(user_id)
+
+@shards.op
+def graph_remove(user_id: int):
+    referral_graph.remove(user_id)
+
+@shards.op
+async def flush_users():
+    await user_store.flush_async()
+
+@shards.op
+async def apply_adjustments(adjustments: list, dry_run: bool) -> list:
+    errors = user_store.apply_adjustments(adjustments, dry_run)
+    if not errors and not dry_run:
+        # All of the batch goes to disk in one transaction
+        await user_store.flush_async()
+    return errors
+
+@shards.op
+def apply_settings(settings: dict):
+    for channel in bot_data.apply(settings):
+        membership_cache.evict_channel(channel)
+
+async def share_settings():
+    """Hand the current settings to the other workers after an admin change."""
+    await shards.broadcast("apply_settings", settings=bot_data.settings())
+
+def parse_adjustments(data: bytes):
+    """(adjustments, errors) from an uploaded CSV of user_id,amount rows, gzipped or not."""
+    try:
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        text = data.decode('utf-8-sig')
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+        # Truncated or corrupt gzip, or not UTF-8 text
+        return [], [f"unreadable file: {e}"]
+    reader = csv.DictReader(io.StringIO(text))
+    adjustments, errors = [], []
+    try:
+        if not reader.fieldnames or not {'user_id', 'amount'} <= {name.strip() for name in reader.fieldnames}:
+            return [], ["the header must have user_id and amount columns"]
+        for row in reader:
+            row = {(key or '').strip(): (value or '').strip() for key, value in row.items()}
+            if not row['user_id'] and not row['amount']:
+                continue
+            try:
+                user_id = int(row['user_id'])
+                amount = float(row['amount'])
+                if not math.isfinite(amount):
+                    raise ValueError(row['amount'])
+                adjustments.append((user_id, int(amount) if amount.is_integer() else amount))
+            except ValueError:
+                errors.append(f"line {reader.line_num}: invalid user_id or amount")
+    except csv.Error as e:
+        return [], [f"line {reader.line_num}: {e}"]
+    return adjustments, errors
+
+async def import_adjustments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Apply an uploaded balance adjustment file sent after /admin import."""
+    context.user_data['expecting_import'] = False
+    document = update.message.document
+    file = await context.bot.get_file(document.file_id)
+    adjustments, errors = parse_adjustments(bytes(await file.download_as_bytearray()))
+    if not errors and not adjustments:
+        errors = ["no rows"]
+    applied = []
+    if not errors:
+        by_shard = {}
+        for user_id, amount in adjustments:
+            by_shard.setdefault(shards.shard_of(user_id), []).append((user_id, amount))
+        # Check every shard first so a bad row anywhere leaves all balances untouched
+        for dry_run in (True, False):
+            results = await asyncio.gather(*(shards.call_shard(index, "apply_adjustments", adjustments=batch, dry_run=dry_run)
+                                             for index, batch in by_shard.items()))
+            errors = [error for result in results for error in result]
+            if errors:
+                # Failing after the check means a balance changed in between; other shards may have applied
+                applied = [] if dry_run else [index for index, result in zip(by_shard, results) if not result]
+                break
+    if errors:
+        outcome = f"partly applied (workers {applied})" if applied else "rejected, nothing was changed"
+        await update.message.reply_text(
+            f"❌ Import of {document.file_name} {outcome}. {len(errors)} problem(s):\n" +
+            "\n".join(errors[:20]) + ("\n…" if len(errors) > 20 else "")
+        )
+        return
+    credited = sum(amount for _, amount in adjustments if amount > 0)
+    debited = -sum(amount for _, amount in adjustments if amount < 0)
+    await update.message.reply_text(
+        f"✅ Imported {document.file_name}\n\n"
+        f"📄 Rows: {len(adjustments)}\n"
+        f"👤 Users: {len({user_id for user_id, _ in adjustments})}\n"
+        f"➕ Added: {credited} ⭐\n"
+        f"➖ Deducted: {debited} ⭐"
+    )
+
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Profile", callback_data="profile"),
+     InlineKeyboardButton("⭐ Earn Stars", callback_data="referral")],
+    [InlineKeyboardButton("💎 Withdraw Stars", callback_data="withdraw")],
+    [InlineKeyboardButton("📝 Set Post Link", callback_data="set_wallet")]
+])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="back_to_main")]])
+WITHDRAW_AMOUNTS = (1, 2, 3, 4, 5, 6, 7)
+WITHDRAW_AMOUNTS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{amount}⭐", callback_data=f"withdraw_{amount}") for amount in WITHDRAW_AMOUNTS[i:i + 2]]
+    for i in range(0, len(WITHDRAW_AMOUNTS), 2)
+])
+
+def withdraw_amount(raw: str) -> int:
+    """Parse the <n> of withdraw_<n>; only the amounts on the keyboard are accepted."""
+    amount = int(raw)
+    if amount not in WITHDRAW_AMOUNTS:
+        raise ValueError(f"not a withdrawal amount: {raw}")
+    return amount
+
+async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
     query = update.callback_query
     user_id = query.from_user.id
-    await ensure_user_exists(user_id)
+    user_data = user_store.get_user(user_id)
+    rank = user_store.leaderboard.rank(user_data.referrals)
+    await query.answer()
+    await query.message.edit_text(
+        f"👤 Your Profile\n\n"
+        f"📱 User ID: {user_id}\n"
+        f"💰 Balance: {user_data.balance} ⭐\n"
+        f"👥 Referrals: {user_data.referrals}\n" +
+        (f"🏆 Rank: #{rank} of {len(user_store.leaderboard)} referrers\n" if rank else "") +
+        f"📝 Post Link: {user_data.wallet or 'Not set'}",
+        reply_markup=BACK_MARKUP
+    )
 
-    if query.data != "check_membership":
-        is_member = await check_member(user_id, context.bot)
-        if not is_member:
-            await query.answer("⚠️ Please join our channels first!", show_alert=True)
-            return
+async def check_withdrawal_allowed(query) -> bool:
+    """Answer the query and return False if withdrawals are closed or the user has no post link."""
+    if not bot_data.withdrawal_open:
+        await query.answer("Withdrawals are currently closed!")
+        return False
+    if not user_store.get_user(query.from_user.id).wallet:
+        await query.answer("⚠️ Please set your post link first!", show_alert=True)
+        return False
+    return True
 
-    if query.data == "profile":
-        user_data = bot_data.users[user_id]
-        await query.answer()
-        keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="back_to_main")]]
-        await query.message.edit_text(
-            f"👤 Your Profile\n\n"
-            f"📱 User ID: {user_id}\n"
-            f"💰 Balance: {user_data['balance']} ⭐\n"
-            f"👥 Referrals: {user_data['referrals']}\n"
-            f"📝 Post Link: {user_data.get('wallet', 'Not set')}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+async def show_withdraw_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_data = user_store.get_user(query.from_user.id)
+    balance = user_data.balance
+    if balance < bot_data.min_withdrawal:
+        await query.message.reply_text("⚠️ Not enough balance for withdrawal!")
 
-    elif query.data == "withdraw":
-        if not bot_data.withdrawal_open:
-            await query.answer("Withdrawals are currently closed!")
-            return
+    await query.message.reply_text(
+        f"💳 Select the amount to withdraw\n\nBalance: {balance}⭐\n\n" + "\n".join([f"{channel} - withdrawals channel" for channel in bot_data.withdrawal_channels]),
+        reply_markup=WITHDRAW_AMOUNTS_MARKUP
+    )
 
-        if not bot_data.users[user_id].get('wallet'):
-            await query.answer("⚠️ Please set your post link first!", show_alert=True)
-            return
+async def request_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: int):
+    query = update.callback_query
+    user_id = query.from_user.id
 
-        balance = bot_data.users[user_id]['balance']
-        if balance < bot_data.min_withdrawal:
-            await query.message.reply_text("⚠️ Not enough balance for withdrawal!")
+    if not bot_data.min_withdrawal <= amount <= bot_data.max_withdrawal:
+        await query.answer(f"⚠️ Withdrawals must be between {bot_data.min_withdrawal}⭐ and "
+                           f"{bot_data.max_withdrawal}⭐!", show_alert=True)
+        return
 
-        withdrawal_keyboard = [
-            [InlineKeyboardButton(f"1⭐", callback_data="withdraw_1"),
-             InlineKeyboardButton(f"2⭐", callback_data="withdraw_2")],
-            [InlineKeyboardButton(f"3⭐", callback_data="withdraw_3"),
-             InlineKeyboardButton(f"4⭐", callback_data="withdraw_4")],
-            [InlineKeyboardButton(f"5⭐", callback_data="withdraw_5"),
-             InlineKeyboardButton(f"6⭐", callback_data="withdraw_6")],
-            [InlineKeyboardButton(f"7⭐", callback_data="withdraw_7")]
-        ]
-        await query.message.reply_text(
-            f"💳 Select the amount to withdraw\n\nBalance: {balance}⭐\n\n" + "\n".join([f"{channel} - withdrawals channel" for channel in bot_data.withdrawal_channels]),
-            reply_markup=InlineKeyboardMarkup(withdrawal_keyboard)
+    # One request per amount keyboard: repeated taps on it are duplicates
+    idempotency_key = f"{user_id}:{query.message.message_id}"
+    if withdrawal_ledger.exists(idempotency_key):
+        await query.answer("This withdrawal request was already received.")
+        return
+
+    # Deduct the balance (check and deduct in one step)
+    if user_store.adjust_balance(user_id, -amount, min_balance=0) is None:
+        await query.answer("⚠️ Not enough balance!", show_alert=True)
+        return
+
+    user_data = user_store.get_user(user_id)
+    user_post_link = user_data.wallet or 'Not set'
+    try:
+        withdrawal_id = await withdrawal_ledger.record(
+            idempotency_key, user_id, query.from_user.username, amount, user_post_link
         )
+    except Exception:
+        # No ledger row, so the stars must not stay debited
+        user_store.adjust_balance(user_id, amount)
+        await query.answer("⚠️ Could not record the withdrawal, please try again.", show_alert=True)
+        raise
+    if withdrawal_id is None:
+        user_store.adjust_balance(user_id, amount)
+        await query.answer("This withdrawal request was already received.")
         return
 
-    elif query.data.startswith("withdraw_"):
-        amount = int(query.data.split("_")[1])
-        balance = bot_data.users[user_id]['balance']
+    # The request goes out to the admin and payout channel with the next digest
+    await query.answer(f"Withdrawal request #{withdrawal_id} sent to admin!")
+    await query.message.edit_text("Withdrawal request sent! Click below to go back.", reply_markup=BACK_MARKUP)
 
-        if balance < amount:
-            await query.answer("⚠️ Not enough balance!", show_alert=True)
-            return
+async def show_promotion(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text("For promotion of your channel D.M @SPIDERMAN383")
 
-        user_post_link = bot_data.users[user_id].get('wallet', 'Not set')
-        user = await context.bot.get_chat(user_id)
-        bot = await context.bot.get_me()
+async def ask_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text("Send your post link where you want to receive your stars ⭐")
+    context.user_data['expecting_wallet'] = True
 
-        # Create withdrawal message
-        withdrawal_msg = (f"⭐ New Withdrawal Request (PENDING)\n\n"
-                        f"👤 User: {user_id} (@{user.username if user.username else 'no username'})\n"
-                        f"💰 Amount: {amount}⭐\n"
-                        f"📝 Post Link: {user_post_link}\n"
-                        f"🤖 Bot: @{bot.username}")
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    await update.callback_query.message.edit_text("Select an option:", reply_markup=MAIN_MENU_MARKUP)
 
-        # Deduct the balance
-        bot_data.users[user_id]['balance'] -= amount
+async def verify_membership(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    is_member = await check_member(user_id, context.bot)
+    if is_member:
+        await query.answer("✅ Membership verified!")
+
+        # Convert a pending referral to completed and credit the referrer
+        referrer_id = user_store.complete_referral(user_id, update.effective_user.username)
+        if referrer_id is not None:
+            await shards.call(referrer_id, "credit_referral", reward=bot_data.referral_amount)
+            await shards.gather("graph_complete", user_id=user_id)
+            # Notify referrer
+            outbound.send(
+                referrer_id,
+                f"🎉 Referral Success! @{update.effective_user.username} verified their membership!\n"
+                f"You earned {bot_data.referral_amount} ⭐!"
+            )
+            referral_log.info("Completed referral: %s for referrer: %s", user_id, referrer_id,
+                              extra={"user_id": user_id, "referrer_id": referrer_id})
+        try:
+            await query.message.edit_text(
+                "Select an option:",
+                reply_markup=MAIN_MENU_MARKUP
+            )
+        except:
+            await query.message.reply_text(
+                "Select an option:",
+                reply_markup=MAIN_MENU_MARKUP
+            )
+    else:
+        await query.answer("⚠️ Please join all required channels first!", show_alert=True)
 
-        # Send to admin and withdrawal channel
-        await context.bot.send_message(chat_id=ADMIN_ID, text=withdrawal_msg)
-        await context.bot.send_message(chat_id="@STAR_REACTION_PAYOUT", text=withdrawal_msg)
+class CallbackRoute:
+    """A callback_data route and the checks that run before its handler.
 
-        await query.answer("Withdrawal request sent to admin!")
+    Routes are keyed by their exact callback data, or by a prefix ending in "_" whose
+    remainder is passed to the handler after parsing with ``payload`` (e.g. withdraw_<n>).
+    withdrawal routes also require withdrawals to be open and a post link to be set.
+    """
 
-        keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="back_to_main")]]
-        await query.message.edit_text("Withdrawal request sent! Click below to go back.", reply_markup=InlineKeyboardMarkup(keyboard))
+    def __init__(self, handler, membership: bool = True, admin_only: bool = False,
+                 ensure_user: bool = True, payload=None, withdrawal: bool = False):
+        self.handler = handler
+        self.membership = membership
+        self.admin_only = admin_only
+        self.ensure_user = ensure_user
+        self.payload = payload
+        self.withdrawal = withdrawal
 
-    elif query.data == "referral":
-        await handle_referral(update, context)
+CALLBACK_ROUTES = {
+    "profile": CallbackRoute(show_profile),
+    # Old amount keyboards stay tappable, so the amount route repeats the menu's checks
+    "withdraw": CallbackRoute(show_withdraw_menu, withdrawal=True),
+    "withdraw_": CallbackRoute(request_withdrawal, payload=withdraw_amount, withdrawal=True),
+    "referral": CallbackRoute(handle_referral),
+    "promotion": CallbackRoute(show_promotion, membership=False, ensure_user=False),
+    "set_wallet": CallbackRoute(ask_wallet),
+    "back_to_main": CallbackRoute(show_main_menu, membership=False, ensure_user=False),
+    # Checks membership itself, and must work for users who haven't joined yet
+    "check_membership": CallbackRoute(verify_membership, membership=False),
+}
 
-    elif query.data == "promotion":
-        await query.answer()
-        await query.message.reply_text("For promotion of your channel D.M @SPIDERMAN383")
+def resolve_callback(data: str):
+    """Return (route key, raw payload) for callback data, or (None, None) if unrouted."""
+    if data in CALLBACK_ROUTES:
+        return data, None
+    prefix, separator, payload = data.rpartition("_")
+    if separator and prefix + separator in CALLBACK_ROUTES:
+        return prefix + separator, payload
+    return None, None
 
-    elif query.data == "set_wallet":
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    key, raw_payload = resolve_callback(query.data or "")
+    if key is None:
         await query.answer()
-        msg = await query.message.reply_text("Send your post link where you want to receive your stars ⭐")
-        context.user_data['expecting_wallet'] = True
-
-    elif query.data == "back_to_main":
-        keyboard = [
-            [InlineKeyboardButton("👤 Profile", callback_data="profile"),
-             InlineKeyboardButton("⭐ Earn Stars", callback_data="referral")],
-            [InlineKeyboardButton("💎 Withdraw Stars", callback_data="withdraw")],
-            [InlineKeyboardButton("📝 Set Post Link", callback_data="set_wallet")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Select an option:", reply_markup=reply_markup)
+        return
+    route = CALLBACK_ROUTES[key]
+
+    if route.admin_only and user_id != ADMIN_ID:
+        await query.answer("You are not authorized to use this.", show_alert=True)
+        return
+
+    payload = None
+    if route.payload is not None:
+        try:
+            payload = route.payload(raw_payload)
+        except ValueError:
+            await query.answer()
+            return
 
-    elif query.data == "check_membership":
+    if route.ensure_user:
+        await ensure_user_exists(user_id)
+
+    if route.membership:
         is_member = await check_member(user_id, context.bot)
-        if is_member:
-            await query.answer("✅ Membership verified!")
-
-            # Check if this user was referred
-            if user_id in bot_data.users and 'referred_by' in bot_data.users[user_id]:
-                    referrer_id = bot_data.users[user_id]['referred_by']
-
-                    # Initialize referrer data structures if needed
-                    if referrer_id not in bot_data.users:
-                        bot_data.users[referrer_id] = {
-                            'balance': 0,
-                            'referrals': 0,
-                            'referral_code': f"REF{referrer_id}",
-                            'wallet': None,
-                            'pending_referrals': [],
-                            'completed_referrals': []
-                        }
-
-                    if 'pending_referrals' not in bot_data.users[referrer_id]:
-                        bot_data.users[referrer_id]['pending_referrals'] = []
-                    if 'completed_referrals' not in bot_data.users[referrer_id]:
-                        bot_data.users[referrer_id]['completed_referrals'] = []
-
-                    # Check if referral is pending and not already completed
-                    completed_refs = [ref['user_id'] for ref in bot_data.users[referrer_id]['completed_referrals']]
-                    if user_id in bot_data.users[referrer_id]['pending_referrals'] and user_id not in completed_refs:
-                        # Convert pending referral to completed
-                        bot_data.users[referrer_id]['pending_referrals'].remove(user_id)
-                        bot_data.users[referrer_id]['completed_referrals'].append({
-                            'user_id': user_id,
-                            'username': update.effective_user.username,
-                            'date': str(datetime.datetime.now())
-                        })
-                        bot_data.users[referrer_id]['referrals'] += 1
-                        bot_data.users[referrer_id]['balance'] += bot_data.referral_amount
-
-                    # Notify referrer
-                    await context.bot.send_message(
-                        chat_id=referrer_id,
-                        text=f"🎉 Referral Success! @{update.effective_user.username} verified their membership!\n"
-                        f"You earned {bot_data.referral_amount} ⭐!"
-                    )
-                    print(f"Completed referral: {user_id} for referrer: {referrer_id}")
-            keyboard = [
-                [InlineKeyboardButton("👤 Profile", callback_data="profile"),
-                 InlineKeyboardButton("⭐ Earn Stars", callback_data="referral")],
-                [InlineKeyboardButton("💎 Withdraw Stars", callback_data="withdraw")],
-                [InlineKeyboardButton("📝 Set Post Link", callback_data="set_wallet")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.message.edit_text(
-                    "Select an option:",
-                    reply_markup=reply_markup
-                )
-            except:
-                await query.message.reply_text(
-                    "Select an option:",
-                    reply_markup=reply_markup
-                )
-        else:
-            await query.answer("⚠️ Please join all required channels first!", show_alert=True)
+        if not is_member:
+            await query.answer("⚠️ Please join our channels first!", show_alert=True)
+            return
 
-async def check_member(user_id: int, bot) -> bool:
-    for channel in bot_data.required_channels:
+    if route.withdrawal and not await check_withdrawal_allowed(query):
+        return
+
+    await route.handler(update, context, payload)
+
+async def resolve_channel_id(channel: str, bot) -> int:
+    """Resolve a @username channel to its numeric chat id once and pin it."""
+    chat_id = bot_data.channel_ids.get(channel)
+    if chat_id is None:
+        chat = await bot.get_chat(channel)
+        chat_id = bot_data.channel_ids[channel] = chat.id
+    return chat_id
+
+async def check_channel_member(user_id: int, channel: str, bot, limit: asyncio.Semaphore) -> bool:
+    async with limit, membership_semaphore:
+        pinned = channel in bot_data.channel_ids
         try:
-            member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                print(f"User {user_id} not member of {channel}")
-                return False
+            member = await bot.get_chat_member(chat_id=bot_data.channel_ids.get(channel, channel), user_id=user_id)
         except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
+            membership_log.warning("Error checking membership for %s: %s", channel, e, extra={"user_id": user_id})
+            if pinned:
+                return False
             try:
                 # Retry with numeric channel ID if possible
-                chat = await bot.get_chat(channel)
-                member = await bot.get_chat_member(chat_id=chat.id, user_id=user_id)
-                if member.status not in ['member', 'administrator', 'creator']:
-                    return False
+                chat_id = await resolve_channel_id(channel, bot)
+                member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
             except Exception as retry_e:
-                print(f"Retry failed for {channel}: {retry_e}")
+                membership_log.warning("Retry failed for %s: %s", channel, retry_e, extra={"user_id": user_id})
                 return False
-    return True
+    is_member = member.status in MEMBER_STATUSES
+    membership_cache.set(user_id, channel, is_member)
+    if not is_member:
+        membership_log.debug("User %s not member of %s", user_id, channel, extra={"user_id": user_id})
+    return is_member
 
-def main():
+async def check_member(user_id: int, bot) -> bool:
+    unchecked = []
+    for channel in bot_data.required_channels:
+        cached = membership_cache.get(user_id, channel)
+        if cached is None:
+            unchecked.append(channel)
+        elif not cached:
+            return False
+    if not unchecked:
+        return True
+
+    # Query the uncached channels concurrently and stop at the first "not a member"
+    limit = asyncio.Semaphore(MEMBERSHIP_CONCURRENCY)
+    tasks = [asyncio.create_task(check_channel_member(user_id, channel, bot, limit)) for channel in unchecked]
     try:
-        print("Starting bot...")
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        for result in asyncio.as_completed(tasks):
+            if not await result:
+                return False
+        return True
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the membership cache in sync with join/leave events from required channels."""
+    member_update = update.chat_member
+    chat = member_update.chat
+    channel = f"@{chat.username}" if chat.username else str(chat.id)
+    if channel not in bot_data.required_channels:
+        return
+    bot_data.channel_ids[channel] = chat.id
+    user_id = member_update.new_chat_member.user.id
+    status = member_update.new_chat_member.status
+    if status in MEMBER_STATUSES:
+        membership_cache.set(user_id, channel, True)
+    elif status in ('left', 'kicked'):
+        membership_cache.set(user_id, channel, False)
+    else:
+        membership_cache.evict(user_id, channel)
+
+async def post_init(application: Application):
+    # Application.initialize() already fetched the bot identity (get_me) once;
+    # warm the per-channel invite links before the first /start arrives
+    log.info("Running as @%s", application.bot.username)
+    await refresh_channel_cache(application.bot)
+    background_tasks.append(asyncio.create_task(user_store.run_flusher(STORE_FLUSH_INTERVAL)))
+    background_tasks.append(outbound.start(application.bot))
+    background_tasks.append(asyncio.create_task(sweeper.run(SWEEP_INTERVAL)))
+    # Digests and broadcasts run once, on the worker that handles the admin's commands
+    if shards.shard_of(ADMIN_ID) == shards.index:
+        background_tasks.append(asyncio.create_task(
+            withdrawal_ledger.run_digests(application.bot, WITHDRAWAL_DIGEST_INTERVAL, WITHDRAWAL_DIGEST_SIZE)
+        ))
+        broadcaster.resume_all(application.bot)
+    if METRICS_PORT and UPDATE_MODE != "webhook" and shards.count == 1:
+        background_tasks.append(asyncio.create_task(start_metrics_server(METRICS_PORT)))
+
+async def post_shutdown(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await shards.close()
+    user_store.close()
+    store_log.info("User store flushed.")
+
+def open_storage():
+    user_store.open()
+    for user_id, referrer_id, date, status in user_store.referral_edges():
+        referral_graph.add(user_id, referrer_id, date, completed=status == 'completed')
+    withdrawal_ledger.open(count_existing=shards.shard_of(ADMIN_ID) == shards.index)
+    broadcaster.open()
+
+def build_application(token: str, base_url: str = None) -> Application:
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 0 else False)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
-        async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            print(f"Error occurred: {context.error}")
+    async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Bot API errors are expected under load; only unexpected errors carry a traceback
+        traceback = None if isinstance(context.error, TelegramError) else context.error
+        log.error("Error occurred: %s", context.error, exc_info=traceback,
+                  extra={"user_id": update.effective_user.id if isinstance(update, Update) and update.effective_user else None})
 
-        application.add_error_handler(error_handler)
+    application.add_error_handler(error_handler)
 
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("start", instrument("start")(serialize_per_user(start))))
+    application.add_handler(CommandHandler("admin", instrument("admin_command")(serialize_per_user(admin_command))))
 
-        async def wrap_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: str):
-            if update.effective_user.id != ADMIN_ID:
-                await update.message.reply_text("⚠️ You are not authorized to use this command.")
-                return
+    @instrument("admin_command")
+    async def wrap_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: str):
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("⚠️ You are not authorized to use this command.")
+            return
+        async with user_locks(update.effective_user.id):
             await admin_command(update, context, override_command=cmd)
 
-        application.add_handler(CommandHandler("help", lambda u,c: wrap_admin_command(u,c, "help")))
-        application.add_handler(CommandHandler("add_balance", lambda u,c: wrap_admin_command(u,c, "add_balance")))
-        application.add_handler(CommandHandler("deduct_balance", lambda u,c: wrap_admin_command(u,c, "deduct_balance")))
-        application.add_handler(CommandHandler("add_channel", lambda u,c: wrap_admin_command(u,c, "add_channel")))
-        application.add_handler(CommandHandler("remove_channel", lambda u,c: wrap_admin_command(u,c, "remove_channel")))
-        application.add_handler(CommandHandler("set_min_withdrawal", lambda u,c: wrap_admin_command(u,c, "set_min_withdrawal")))
-        application.add_handler(CommandHandler("set_referral_amount", lambda u,c: wrap_admin_command(u,c, "set_referral_amount")))
-        application.add_handler(CommandHandler("toggle_withdrawal", lambda u,c: wrap_admin_command(u,c, "toggle_withdrawal")))
-        application.add_handler(CommandHandler("add_withdrawal_channel", lambda u,c: wrap_admin_command(u,c, "add_withdrawal_channel")))
-        application.add_handler(CommandHandler("remove_withdrawal_channel", lambda u,c: wrap_admin_command(u,c, "remove_withdrawal_channel")))
-        async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            if 'expecting_wallet' in context.user_data and context.user_data['expecting_wallet']:
-                user_id = update.effective_user.id
-                post_link = update.message.text
-                bot_data.users[user_id]['wallet'] = post_link
-                context.user_data['expecting_wallet'] = False
-                await update.message.reply_text("✅ Your post link has been saved successfully!")
-            else:
-                print(f"Received message: {update.message.text}")
+    application.add_handler(CommandHandler("help", lambda u,c: wrap_admin_command(u,c, "help")))
+    application.add_handler(CommandHandler("add_balance", lambda u,c: wrap_admin_command(u,c, "add_balance")))
+    application.add_handler(CommandHandler("deduct_balance", lambda u,c: wrap_admin_command(u,c, "deduct_balance")))
+    application.add_handler(CommandHandler("add_channel", lambda u,c: wrap_admin_command(u,c, "add_channel")))
+    application.add_handler(CommandHandler("remove_channel", lambda u,c: wrap_admin_command(u,c, "remove_channel")))
+    application.add_handler(CommandHandler("set_min_withdrawal", lambda u,c: wrap_admin_command(u,c, "set_min_withdrawal")))
+    application.add_handler(CommandHandler("set_referral_amount", lambda u,c: wrap_admin_command(u,c, "set_referral_amount")))
+    application.add_handler(CommandHandler("toggle_withdrawal", lambda u,c: wrap_admin_command(u,c, "toggle_withdrawal")))
+    application.add_handler(CommandHandler("add_withdrawal_channel", lambda u,c: wrap_admin_command(u,c, "add_withdrawal_channel")))
+    application.add_handler(CommandHandler("remove_withdrawal_channel", lambda u,c: wrap_admin_command(u,c, "remove_withdrawal_channel")))
+    async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if 'expecting_wallet' in context.user_data and context.user_data['expecting_wallet']:
+            user_id = update.effective_user.id
+            post_link = update.message.text
+            user_store.set_wallet(user_id, post_link)
+            user_store.touch(user_id)
+            context.user_data['expecting_wallet'] = False
+            await update.message.reply_text("✅ Your post link has been saved successfully!")
+        else:
+            message_log.info("Received message: %s", update.message.text, extra={"user_id": update.effective_user.id})
+
+    application.add_handler(CallbackQueryHandler(instrument(callback_route)(serialize_per_user(button_handler))))
+    application.add_handler(ChatMemberHandler(instrument("track_channel_member")(track_channel_member), ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("handle_message")(serialize_per_user(handle_message))))
+
+    async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id == ADMIN_ID and context.user_data.get('expecting_import'):
+            await import_adjustments(update, context)
+
+    application.add_handler(MessageHandler(filters.Document.ALL, instrument("handle_document")(serialize_per_user(handle_document))))
+    return application
+
+async def serve_metrics(request):
+    from aiohttp import web
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server(port: int):
+    """Serve /metrics on its own port (polling mode has no other HTTP server)."""
+    from aiohttp import web
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", serve_metrics)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, port).start()
+    log.info("Metrics available on %s:%s/metrics", WEBHOOK_LISTEN, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def require_webhook_secret(listen: str):
+    """Refuse to accept updates from the network without a secret token to check."""
+    if not WEBHOOK_SECRET and listen not in ("127.0.0.1", "::1", "localhost"):
+        raise RuntimeError(f"WEBHOOK_SECRET must be set to receive updates on {listen}")
+
+async def serve_webhook(application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                        worker: bool = False):
+    """Receive updates over HTTP instead of long polling.
+
+    POST WEBHOOK_PATH accepts a single Telegram update or a JSON array of updates (so a
+    load balancer or ingress process can forward batches) and queues them for the
+    application. GET /healthz returns 200 once the bot is started and the webhook is set.
+    A worker started by the ingress also serves POST /shard and never sets the webhook.
+    """
+    from aiohttp import web
+
+    require_webhook_secret(listen)
+    ready = False
+    stop = asyncio.Event()
 
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        for data in payload if isinstance(payload, list) else [payload]:
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.Response(status=200 if ready else 503, text="ok" if ready else "starting")
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive)
+    web_app.router.add_get("/healthz", healthz)
+    web_app.router.add_get("/metrics", serve_metrics)
+    if worker:
+        web_app.router.add_post("/shard", shards.handle)
+    runner = web.AppRunner(web_app, access_log=None)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        await post_init(application)
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        if WEBHOOK_URL and not worker:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+        ready = True
+        log.info("Webhook server listening on %s:%s%s", listen, port, WEBHOOK_PATH)
+        await stop.wait()
+    finally:
+        ready = False
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+def shard_key(update: Update) -> int:
+    """User whose worker handles an update: the member for chat_member updates, else the sender."""
+    if update.chat_member:
+        return update.chat_member.new_chat_member.user.id
+    return update.effective_user.id if update.effective_user else 0
+
+async def run_ingress(shard_count: int):
+    """Start shard_count workers and forward every update to the worker owning its user.
+
+    Updates are fetched with getUpdates (or received on the webhook in webhook mode) and
+    posted to the workers' WEBHOOK_PATH in arrival order, one batch per worker. If a worker
+    exits, the ingress stops the others and exits too so the process manager restarts all.
+    """
+    import subprocess
+    from aiohttp import web, ClientSession, ClientError
+    from telegram import Bot
+
+    if UPDATE_MODE == "webhook":
+        require_webhook_secret(WEBHOOK_LISTEN)
+
+    # Run schema migrations once, before the workers open the database concurrently
+    open_storage()
+    user_store.close()
+
+    workers = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                         env={**os.environ, "SHARD_INDEX": str(index), "SHARDS": str(shard_count)})
+        for index in range(shard_count)
+    ]
+    router = ShardRouter(0, shard_count, SHARD_BASE_PORT)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def watch_workers():
+        while not stop.is_set():
+            for index, process in enumerate(workers):
+                if process.poll() is not None:
+                    log.error("Worker %d exited with code %s; stopping", index, process.returncode)
+                    stop.set()
+            await asyncio.sleep(1)
+
+    async def wait_ready(session, index: int):
+        while not stop.is_set():
+            try:
+                async with session.get(f"http://127.0.0.1:{router.port(index)}/healthz") as response:
+                    if response.status == 200:
+                        return
+            except ClientError:
+                pass
+            await asyncio.sleep(0.2)
+
+    async def forward(session, updates: list):
+        batches = {}
+        for update in updates:
+            batches.setdefault(router.shard_of(shard_key(update)), []).append(update.to_dict())
+        for index, batch in batches.items():
+            url = f"http://127.0.0.1:{router.port(index)}{WEBHOOK_PATH}"
+            while not stop.is_set():
+                try:
+                    async with session.post(url, json=batch, headers=headers) as response:
+                        if response.status == 200:
+                            break
+                        log.warning("Worker %d answered %s", index, response.status)
+                except ClientError as e:
+                    log.warning("Error forwarding to worker %d: %s", index, e)
+                await asyncio.sleep(1)
+
+    async def poll(session, bot):
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        while not stop.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=10, read_timeout=20,
+                                                allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                log.warning("getUpdates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if updates:
+                await forward(session, updates)
+                offset = updates[-1].update_id + 1
+
+    async def serve(session, bot):
+        async def receive(request: web.Request) -> web.Response:
+            if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                return web.Response(status=403)
+            try:
+                payload = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            await forward(session, [Update.de_json(data, bot) for data in (payload if isinstance(payload, list) else [payload])])
+            return web.Response()
+
+        web_app = web.Application()
+        web_app.router.add_post(WEBHOOK_PATH, receive)
+        web_app.router.add_get("/healthz", lambda request: web.Response(text="ok"))
+        runner = web.AppRunner(web_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                                  allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
 
-        print("Bot is running! Press Ctrl+C to stop.")
-        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    watcher = asyncio.create_task(watch_workers())
+    try:
+        async with ClientSession() as session, Bot(TELEGRAM_TOKEN, **({"base_url": TELEGRAM_API_URL} if TELEGRAM_API_URL else {})) as bot:
+            await asyncio.gather(*(wait_ready(session, index) for index in range(shard_count)))
+            log.info("Ingress forwarding to %d workers", shard_count)
+            receiver = asyncio.create_task(serve(session, bot) if UPDATE_MODE == "webhook" else poll(session, bot))
+            await stop.wait()
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+    finally:
+        watcher.cancel()
+        for process in workers:
+            if process.poll() is None:
+                process.terminate()
+        for process in workers:
+            process.wait()
+
+def main():
+    listener = setup_logging()
+    try:
+        if SHARDS > 1 and SHARD_INDEX < 0:
+            log.info("Starting ingress with %d workers...", SHARDS)
+            asyncio.run(run_ingress(SHARDS))
+            return
+        log.info("Starting bot...")
+        open_storage()
+        application = build_application(TELEGRAM_TOKEN, TELEGRAM_API_URL)
+
+        log.info("Bot is running! Press Ctrl+C to stop.")
+        if shards.count > 1:
+            asyncio.run(serve_webhook(application, "127.0.0.1", shards.port(shards.index), worker=True))
+        elif UPDATE_MODE == "webhook":
+            asyncio.run(serve_webhook(application))
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
     except Exception as e:
-        print(f"Error starting bot: {e}")
+        log.error("Error starting bot: %s", e)
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,321 @@
+"""Offline load test: run the bot's real Application against a local fake Bot API.
+
+The fake server answers the Bot API methods the bot uses (getMe, getChat,
+getChatMember, sendMessage, editMessageText, answerCallbackQuery, ...) with a
+configurable latency and share of 429 responses. The load generator replays
+scripted user journeys (/start REF..., check_membership, profile, withdraw_N)
+and reports updates/sec, p50/p99 handler latency and Bot API calls per update.
+
+With --shards N the bot runs as a separate ingress process with N workers
+(SHARDS=N) polling the fake server's getUpdates; every journey is queued up front
+and the run ends once the Bot API traffic settles.
+
+Usage: python loadtest.py --users 500 --concurrency 50 --latency 0.05 --flood-rate 0.01
+       python loadtest.py --users 500 --shards 4
+"""
+import os
+import sys
+import time
+import random
+import signal
+import sqlite3
+import asyncio
+import argparse
+import contextlib
+import tempfile
+import itertools
+from collections import Counter, deque
+
+from aiohttp import web
+
+# Keep the benchmark's database away from the real one; must be set before importing the bot
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "bot.db"))
+os.environ.setdefault("ARCHIVE_PATH", os.path.join(os.path.dirname(os.environ["DATABASE_PATH"]), "bot-archive.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import hhhh  # noqa: E402
+from telegram import Update  # noqa: E402
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "loadtest_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+class FakeBotAPI:
+    """Minimal Bot API stand-in served at http://host:port/bot<token>/<method>."""
+
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0, non_member_rate: float = 0.0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.non_member_rate = non_member_rate
+        self.calls = Counter()
+        self.floods = 0
+        self._message_ids = itertools.count(1000)
+        self.updates = deque()  # served to getUpdates callers
+        self.last_call = time.monotonic()
+        self._runner = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        self.last_call = time.monotonic()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method not in ("getMe", "getUpdates") and random.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        handler = getattr(self, f"_{method}", None)
+        result = handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        deadline = time.monotonic() + min(float(params.get("timeout") or 0), 1.0)
+        while not self.updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return list(itertools.islice(self.updates, int(params.get("limit") or 100)))
+
+    @staticmethod
+    def _chat(chat_id) -> dict:
+        if str(chat_id).startswith("@") or str(chat_id).startswith("-"):
+            username = str(chat_id).lstrip("@") if str(chat_id).startswith("@") else "channel"
+            return {"id": -1000000000000 - abs(hash(username)) % 10**9, "type": "channel",
+                    "title": username, "username": username, "invite_link": f"https://t.me/+{username}"}
+        chat_id = int(chat_id)
+        return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}", "username": f"user{chat_id}"}
+
+    def _message(self, params: dict) -> dict:
+        chat = self._chat(params.get("chat_id", 1))
+        return {"message_id": int(params.get("message_id") or next(self._message_ids)), "date": int(time.time()),
+                "chat": chat, "from": BOT_USER, "text": params.get("text", "")}
+
+    def _getMe(self, params):
+        return BOT_USER
+
+    def _getChat(self, params):
+        return self._chat(params["chat_id"])
+
+    def _getChatMember(self, params):
+        user_id = int(params["user_id"])
+        status = "left" if random.random() < self.non_member_rate else "member"
+        return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+
+    def _createChatInviteLink(self, params):
+        return {"invite_link": "https://t.me/+created", "creator": BOT_USER, "creates_join_request": False,
+                "is_primary": False, "is_revoked": False}
+
+    def _sendMessage(self, params):
+        return self._message(params)
+
+    def _editMessageText(self, params):
+        return self._message(params)
+
+
+class Journeys:
+    """Builds the raw update dicts for scripted user journeys."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def command(self, user_id: int, text: str) -> dict:
+        command = text.split()[0]
+        return {"update_id": next(self._update_ids), "message": {
+            "message_id": next(self._message_ids), "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id = next(self._update_ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": next(self._message_ids), "date": int(time.time()), "text": "Select an option:",
+                        "chat": {"id": user_id, "type": "private"}, "from": BOT_USER}}}
+
+    def journey(self, user_id: int, referrer_id: int, withdraw_amount: int) -> list:
+        return [
+            self.command(user_id, f"/start REF{referrer_id}"),
+            self.callback(user_id, "check_membership"),
+            self.callback(user_id, "profile"),
+            self.callback(user_id, f"withdraw_{withdraw_amount}"),
+        ]
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(args) -> dict:
+    fake = FakeBotAPI(args.latency, args.flood_rate, args.non_member_rate)
+    await fake.start()
+
+    hhhh.open_storage()
+    application = hhhh.build_application("123456:LOADTEST", fake.base_url)
+    await application.initialize()
+    await hhhh.post_init(application)
+    await application.start()
+
+    first_user = 10_000
+    user_ids = list(range(first_user, first_user + args.users))
+    hhhh.user_store.create_user(first_user - 1)  # referrer of the first user
+    for user_id in user_ids:
+        hhhh.user_store.adjust_balance(user_id, args.seed_balance)
+    startup_calls = Counter(fake.calls)
+
+    journeys = Journeys()
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def replay(user_id: int):
+        async with semaphore:
+            for data in journeys.journey(user_id, user_id - 1, random.randint(1, 7)):
+                update = Update.de_json(data, application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(replay(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+    handler_calls = sum((fake.calls - startup_calls).values())
+
+    # Let queued notifications drain before counting background API calls
+    deadline = time.monotonic() + args.drain
+    while sum(hhhh.outbound.depth) and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+    await application.stop()
+    await application.shutdown()
+    await hhhh.post_shutdown(application)
+    await fake.stop()
+
+    updates = len(latencies)
+    return {
+        "updates": updates,
+        "elapsed_s": elapsed,
+        "updates_per_s": updates / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "api_calls_per_update": handler_calls / updates,
+        "api_calls_total": sum((fake.calls - startup_calls).values()),
+        "api_calls_by_method": dict((fake.calls - startup_calls).most_common()),
+        "flood_responses": fake.floods,
+        "outbound_left_in_queue": sum(hhhh.outbound.depth),
+    }
+
+
+async def run_sharded(args) -> dict:
+    fake = FakeBotAPI(args.latency, args.flood_rate, args.non_member_rate)
+    await fake.start()
+
+    first_user = 10_000
+    user_ids = list(range(first_user, first_user + args.users))
+    # Seed the database before the workers open it
+    hhhh.open_storage()
+    hhhh.user_store.create_user(first_user - 1)
+    for user_id in user_ids:
+        hhhh.user_store.adjust_balance(user_id, args.seed_balance)
+    hhhh.user_store.close()
+
+    env = {**os.environ, "SHARDS": str(args.shards), "TELEGRAM_TOKEN": "123456:LOADTEST",
+           "TELEGRAM_API_URL": fake.base_url, "UPDATE_MODE": "polling", "SHARD_BASE_PORT": str(args.shard_base_port)}
+    env.pop("SHARD_INDEX", None)
+    ingress = await asyncio.create_subprocess_exec(sys.executable, hhhh.__file__, env=env)
+    while not fake.calls["getUpdates"]:  # the ingress polls once every worker is ready
+        if ingress.returncode is not None:
+            raise RuntimeError(f"ingress exited with code {ingress.returncode}")
+        await asyncio.sleep(0.1)
+    startup_calls = Counter(fake.calls)
+
+    # One step of every journey at a time, so each user's updates stay in order
+    journeys = Journeys()
+    steps = [journeys.journey(user_id, user_id - 1, random.randint(1, 7)) for user_id in user_ids]
+    for step in zip(*steps):
+        fake.updates.extend(step)
+    for update_id, data in enumerate(fake.updates, 1):  # getUpdates offsets need increasing ids
+        data["update_id"] = update_id
+    updates = len(fake.updates)
+
+    started = time.monotonic()
+    while fake.updates or time.monotonic() - fake.last_call < 1.0:
+        await asyncio.sleep(0.1)
+    elapsed = fake.last_call - started
+
+    ingress.send_signal(signal.SIGTERM)
+    await ingress.wait()
+    await fake.stop()
+
+    calls = fake.calls - startup_calls
+    del calls["getUpdates"]
+    with contextlib.closing(sqlite3.connect(hhhh.DATABASE_PATH)) as conn:
+        referrals = conn.execute("SELECT COALESCE(SUM(referrals), 0) FROM users").fetchone()[0]
+    return {
+        "shards": args.shards,
+        "updates": updates,
+        "elapsed_s": elapsed,
+        "updates_per_s": updates / elapsed,
+        "api_calls_per_update": sum(calls.values()) / updates,
+        "api_calls_total": sum(calls.values()),
+        "api_calls_by_method": dict(calls.most_common()),
+        "flood_responses": fake.floods,
+        "referrals_credited": referrals,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users (one journey each)")
+    parser.add_argument("--concurrency", type=int, default=50, help="journeys replayed at the same time")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake Bot API latency per call, seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--non-member-rate", type=float, default=0.0, help="share of getChatMember calls answered 'left'")
+    parser.add_argument("--seed-balance", type=int, default=5, help="starting balance given to every user")
+    parser.add_argument("--drain", type=float, default=5.0, help="seconds to wait for queued notifications")
+    parser.add_argument("--shards", type=int, default=1, help="run as an ingress with this many worker processes")
+    parser.add_argument("--shard-base-port", type=int, default=18600, help="first worker port when sharded")
+    args = parser.parse_args()
+
+    listener = hhhh.setup_logging()
+    try:
+        results = asyncio.run(run_sharded(args) if args.shards > 1 else run(args))
+    finally:
+        listener.stop()
+    for key, value in results.items():
+        print(f"{key:>24}: {value:.2f}" if isinstance(value, float) else f"{key:>24}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
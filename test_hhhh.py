@@ -0,0 +1,305 @@
+"""Unit tests for hhhh.py's stores, indexes and parsers.
+
+Run with: python -m pytest -q (or python -m unittest test_hhhh)
+"""
+
+import os
+import asyncio
+import gzip
+import tempfile
+import unittest
+from unittest import mock
+
+import hhhh
+
+
+class StoreTestCase(unittest.IsolatedAsyncioTestCase):
+    """Opens a UserStore on fresh database files for each test."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = hhhh.UserStore(os.path.join(directory.name, "bot.db"), 100,
+                                    os.path.join(directory.name, "bot-archive.db"))
+        self.store.open()
+        self.addCleanup(self.store.close)
+
+
+class LeaderboardTest(unittest.TestCase):
+    def test_top_and_rank(self):
+        board = hhhh.Leaderboard()
+        board.update(1, 2)
+        board.update(2, 5)
+        board.update(3, 2)
+        self.assertEqual(board.top(2), [(2, 5), (1, 2)])
+        self.assertEqual(board.top(-1), [])
+        self.assertEqual(board.rank(5), 1)
+        self.assertEqual(board.rank(2), 2)  # ties share a rank
+        self.assertEqual(board.rank(3), 2)
+        self.assertIsNone(board.rank(0))
+        self.assertEqual(len(board), 3)
+
+    def test_load_matches_updates(self):
+        loaded, updated = hhhh.Leaderboard(), hhhh.Leaderboard()
+        rows = [(7, 4), (3, 2), (9, 2), (1, 1)]
+        loaded.load(rows)
+        for user_id, referrals in reversed(rows):
+            updated.update(user_id, referrals)
+        self.assertEqual(loaded.top(10), updated.top(10))
+        loaded.update(1, 5)
+        self.assertEqual(loaded.top(2), [(1, 5), (7, 4)])
+
+    def test_updates_repeated_or_out_of_order_converge(self):
+        in_order, shuffled = hhhh.Leaderboard(), hhhh.Leaderboard()
+        for user_id, referrals in [(1, 1), (2, 1), (1, 2), (1, 3), (2, 2)]:
+            in_order.update(user_id, referrals)
+        for user_id, referrals in [(1, 3), (2, 2), (1, 1), (2, 1), (1, 3), (1, 2)]:
+            shuffled.update(user_id, referrals)
+        self.assertEqual(shuffled.top(10), in_order.top(10))
+        self.assertEqual(shuffled.top(10), [(1, 3), (2, 2)])
+        self.assertEqual(len(shuffled), 2)
+
+    def test_out_of_sync_entry_is_refused(self):
+        board = hhhh.Leaderboard()
+        board.update(1, 2)
+        board._ranked.clear()
+        with self.assertRaises(RuntimeError):
+            board.update(1, 3)
+
+
+class ReferralGraphTest(unittest.TestCase):
+    def graph(self, burst_size=3, chain_length=3):
+        return hhhh.ReferralGraph(burst_size, chain_length)
+
+    def test_counts_follow_add_complete_remove(self):
+        graph = self.graph()
+        graph.add(2, 1, "2024-01-01 10:00:00")
+        graph.add(3, 2, "2024-01-01 10:01:00", completed=True)
+        graph.add(4, 2, "2024-01-01 10:02:00")
+        self.assertEqual(graph.info(1)['downstream'], 3)
+        self.assertEqual(graph.info(1)['completed'], 1)
+        self.assertEqual(graph.info(1)['levels'], 2)
+        self.assertEqual(graph.info(3)['depth'], 2)
+
+        graph.complete(2)
+        self.assertEqual(graph.info(1)['completed'], 2)
+
+        graph.remove(3)
+        graph.remove(4)
+        self.assertEqual(graph.info(1), {'referrer': None, 'depth': 0, 'direct': 1, 'downstream': 1,
+                                         'completed': 1, 'levels': 1, 'flags': []})
+        self.assertEqual(graph.info(2)['levels'], 0)
+
+    def test_ring_is_flagged_and_cleared_on_remove(self):
+        graph = self.graph()
+        graph.add(2, 1, "2024-01-01 10:00:00")
+        graph.add(1, 2, "2024-01-01 10:01:00")
+        self.assertIsNone(graph.info(1)['referrer'])
+        self.assertEqual(graph.info(1)['flags'], ['ring'])
+        self.assertEqual(graph.info(2)['flags'], ['ring'])
+
+        graph.remove(1)
+        self.assertEqual(graph.flags, {})
+        self.assertEqual(graph.info(2)['referrer'], 1)
+
+    def test_burst_counts_referrals_in_the_same_minute(self):
+        graph = self.graph(burst_size=3)
+        graph.add(2, 1, "2024-01-01 10:00:01")
+        graph.add(3, 1, "2024-01-01 10:00:30")
+        graph.add(4, 1, "2024-01-01 10:01:00")
+        self.assertEqual(graph.info(1)['flags'], [])
+        graph.add(5, 1, "2024-01-01 10:00:59")
+        self.assertEqual(graph.info(1)['flags'], ['burst'])
+
+        graph.remove(3)
+        self.assertEqual(graph.info(1)['flags'], [])
+
+    def test_chain_clears_when_it_branches(self):
+        graph = self.graph(chain_length=3)
+        graph.add(2, 1, "2024-01-01 10:00:00")
+        graph.add(3, 2, "2024-01-02 10:00:00")
+        self.assertEqual(graph.flags, {})
+        graph.add(4, 3, "2024-01-03 10:00:00")
+        self.assertEqual(graph.info(1)['flags'], ['chain'])
+
+        graph.add(5, 2, "2024-01-04 10:00:00")
+        self.assertEqual(graph.flags, {})
+
+        graph.remove(5)
+        self.assertEqual(graph.info(1)['flags'], ['chain'])
+        graph.remove(4)
+        self.assertEqual(graph.flags, {})
+
+    def test_flags_match_a_replay_of_the_remaining_edges(self):
+        edges = [(2, 1, "2024-01-01 10:00:00"), (3, 1, "2024-01-01 10:00:10"), (4, 1, "2024-01-01 10:00:20"),
+                 (5, 4, "2024-01-01 11:00:00"), (6, 5, "2024-01-01 12:00:00"), (7, 6, "2024-01-01 13:00:00"),
+                 (1, 7, "2024-01-01 14:00:00"), (8, 9, "2024-01-01 15:00:00"), (9, 8, "2024-01-01 16:00:00")]
+        graph = self.graph()
+        for edge in edges:
+            graph.add(*edge)
+        graph.complete(9)  # refused as a ring when completed
+        graph.remove(3)
+        graph.remove(1)
+        graph.remove(8)  # breaks the loop 9 -> 8 would have closed
+
+        replay = self.graph()
+        for edge in edges:
+            if edge[0] not in (3, 1, 8):
+                replay.add(*edge, completed=edge[0] == 9)
+        self.assertEqual(graph.flags, replay.flags)
+        self.assertEqual(graph.flags, {4: {'chain'}})
+        for user_id in range(1, 10):
+            self.assertEqual(graph.info(user_id), replay.info(user_id))
+        self.assertEqual(graph.info(8)['downstream'], 1)
+        self.assertEqual(graph.info(8)['completed'], 1)
+
+
+class AdjustBalanceTest(StoreTestCase):
+    def test_min_balance_guards_the_debit(self):
+        self.assertEqual(self.store.adjust_balance(1, 5), 5)
+        self.assertEqual(self.store.adjust_balance(1, -3, min_balance=0), 2)
+        self.assertIsNone(self.store.adjust_balance(1, -3, min_balance=0))
+        self.assertEqual(self.store.get_user(1).balance, 2)
+        self.assertEqual(self.store.total_balance, 2)
+
+    async def test_concurrent_debits_never_overdraw(self):
+        self.store.adjust_balance(1, 10)
+
+        async def debit():
+            await asyncio.sleep(0)
+            return self.store.adjust_balance(1, -3, min_balance=0)
+
+        results = await asyncio.gather(*(debit() for _ in range(10)))
+        self.assertEqual(sum(result is not None for result in results), 3)
+        self.assertEqual(self.store.get_user(1).balance, 1)
+
+    async def test_balance_survives_a_flush_and_reopen(self):
+        self.store.adjust_balance(1, 4)
+        await self.store.flush_async()
+        reopened = hhhh.UserStore(self.store.path, 100, self.store.archive_path)
+        reopened.open()
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.get_user(1).balance, 4)
+
+
+class WithdrawalLedgerTest(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ledger = hhhh.WithdrawalLedger(self.store)
+        self.ledger.open()
+
+    async def test_record_is_idempotent(self):
+        first = await self.ledger.record("7:100", 7, "alice", 5, "https://t.me/c/1")
+        self.assertIsNotNone(first)
+        self.assertIsNone(await self.ledger.record("7:100", 7, "alice", 5, "https://t.me/c/1"))
+        self.assertTrue(self.ledger.exists("7:100"))
+        self.assertEqual(self.ledger.counts(), {'pending': 1})
+        self.assertEqual((self.ledger.open_count, self.ledger.open_amount), (1, 5))
+
+    async def test_transitions_only_move_forward(self):
+        ids = [await self.ledger.record(f"7:{n}", 7, "alice", n, "link") for n in (1, 2, 3)]
+        self.assertEqual(await self.ledger.transition(ids[:2], 'sent'), 2)
+        self.assertEqual(await self.ledger.transition(ids[:1], 'sent'), 0)
+        self.assertEqual(await self.ledger.transition([ids[2]], 'held'), 1)
+        self.assertEqual(await self.ledger.transition([ids[1]], 'held'), 0)  # only pending requests are held
+
+        self.assertEqual(await self.ledger.transition([ids[0]], 'paid'), 1)
+        self.assertEqual(await self.ledger.transition([ids[0]], 'rejected'), 0)
+        self.assertEqual(await self.ledger.transition([ids[2]], 'rejected'), 1)
+        self.assertEqual(self.ledger.get(ids[1])['state'], 'sent')
+        self.assertEqual((self.ledger.open_count, self.ledger.open_amount), (1, 2))
+
+    async def test_open_counts_existing_requests(self):
+        ids = [await self.ledger.record(f"7:{n}", 7, "alice", n, "link") for n in (1, 2, 4)]
+        await self.ledger.transition([ids[0]], 'paid')
+        await self.ledger.transition([ids[1]], 'held')
+        reopened = hhhh.WithdrawalLedger(self.store)
+        reopened.open()
+        self.assertEqual((reopened.open_count, reopened.open_amount), (2, 6))
+
+
+class AggregatesTest(StoreTestCase):
+    def test_reopen_restores_totals_and_leaderboard(self):
+        for user_id in (1, 2, 3):
+            self.store.create_user(user_id)
+        for referrer_id in (2, 2, 3):
+            self.store.credit_referral(referrer_id, 1)
+        self.store.close()
+        self.store.open()
+        self.assertEqual(self.store.leaderboard.top(10), [(2, 2), (3, 1)])
+        self.assertEqual((self.store.total_users, self.store.total_balance, self.store.total_referrals), (3, 3, 3))
+
+
+class ParseAdjustmentsTest(unittest.TestCase):
+    def test_plain_and_gzipped_csv(self):
+        data = b"user_id,amount\n1,5\n2,-2.5\n\n3, 4 \n"
+        expected = ([(1, 5), (2, -2.5), (3, 4)], [])
+        self.assertEqual(hhhh.parse_adjustments(data), expected)
+        self.assertEqual(hhhh.parse_adjustments(gzip.compress(data)), expected)
+
+    def test_invalid_rows_are_reported(self):
+        adjustments, errors = hhhh.parse_adjustments(b"user_id,amount\n1,5\nx,1\n2,nan\n3,inf\n4,\n")
+        self.assertEqual(adjustments, [(1, 5)])
+        self.assertEqual(errors, [f"line {n}: invalid user_id or amount" for n in (3, 4, 5, 6)])
+
+    def test_missing_columns(self):
+        self.assertEqual(hhhh.parse_adjustments(b"id,amount\n1,5\n"),
+                         ([], ["the header must have user_id and amount columns"]))
+
+    def test_unreadable_files_are_rejected(self):
+        compressed = gzip.compress(b"user_id,amount\n1,5\n")
+        for data in (compressed[:-4], b"\x1f\x8bnot gzip", b"user_id,amount\n1,\xff\n",
+                     b"user_id,amount\n1," + b"9" * 200000 + b"\n"):
+            adjustments, errors = hhhh.parse_adjustments(data)
+            self.assertEqual(adjustments, [])
+            self.assertEqual(len(errors), 1)
+
+
+class ApplyAdjustmentsTest(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        for user_id, balance in ((1, 10), (2, 3)):
+            self.store.create_user(user_id).balance = balance
+        self.store.total_balance = 13
+
+    def test_applies_net_amounts(self):
+        self.assertEqual(self.store.apply_adjustments([(1, 5), (2, -3), (1, -15)]), [])
+        self.assertEqual((self.store.get_user(1).balance, self.store.get_user(2).balance), (0, 0))
+        self.assertEqual(self.store.total_balance, 0)
+
+    def test_any_problem_changes_nothing(self):
+        errors = self.store.apply_adjustments([(1, 5), (2, -4), (9, 1)])
+        self.assertEqual(len(errors), 2)
+        self.assertEqual((self.store.get_user(1).balance, self.store.get_user(2).balance), (10, 3))
+        self.assertEqual(self.store.total_balance, 13)
+
+    def test_dry_run_changes_nothing(self):
+        self.assertEqual(self.store.apply_adjustments([(1, 5)], dry_run=True), [])
+        self.assertEqual(self.store.get_user(1).balance, 10)
+
+
+class WithdrawCallbackTest(StoreTestCase):
+    def test_only_keyboard_amounts_are_accepted(self):
+        for amount in hhhh.WITHDRAW_AMOUNTS:
+            key, raw = hhhh.resolve_callback(f"withdraw_{amount}")
+            self.assertEqual(hhhh.CALLBACK_ROUTES[key].payload(raw), amount)
+        for raw in ("-5", "0", "8", "1.5", "x", ""):
+            with self.assertRaises(ValueError):
+                hhhh.withdraw_amount(raw)
+
+    async def test_closed_withdrawals_and_missing_link_are_refused(self):
+        query = mock.AsyncMock()
+        query.from_user.id = 7
+        user = self.store.create_user(7)
+        with mock.patch.object(hhhh, "user_store", self.store), \
+                mock.patch.object(hhhh.bot_data, "withdrawal_open", True):
+            self.assertFalse(await hhhh.check_withdrawal_allowed(query))
+            user.wallet = "https://t.me/c/1"
+            self.assertTrue(await hhhh.check_withdrawal_allowed(query))
+            hhhh.bot_data.withdrawal_open = False
+            self.assertFalse(await hhhh.check_withdrawal_allowed(query))
+        self.assertTrue(hhhh.CALLBACK_ROUTES["withdraw_"].withdrawal)
+
+
+if __name__ == "__main__":
+    unittest.main()